@@ -8,7 +8,7 @@
     filter-dvars.py: Generates dHCP participants list after frame censoring from DVARS threshold.
     
     Description: This scripts generates a new output table with the amount of frames over the subject-specific DVARS threshold (1.5 times over IQR). It is also used to filter out the subjects with too many frames over the subject-specific DVARS threshold (less than 1600 remianing frames).
-    The main function takes the previously created DVARS table in the canonical DHCP func subject directory, (it must have been previously created using the `fsl_motion_outliers` command).
+    The main function takes the previously created DVARS table in the canonical DHCP func subject directory, (it must have been previously created using the `fsl_motion_outliers` command, or with --compute_dvars).
     The script is written to run in a multithread setting. The input parameters specific to the dhcp dataset are "hardcoded" both in the dhcpy library and in this script
     
     Input: The remaining input parameters are as follows:
@@ -16,18 +16,68 @@
         --in ~ participants table to use as input, csv or tsv.
     	--out ~ output pickle file path to pickle output. After DVARS frame censoring
     	--threads ~ amount of threads to be used.
+    	--crop_threads ~ amount of sessions cropped at the same time (I/O bound).
+    	--crop_method ~ native (in-process, default) or fsl (fslsplit/fslmerge).
+    	--crop_format ~ gz (default), bgz (block gzip compressed by --gzip_threads threads per session, a valid .nii.gz)
+    	    or nii (uncompressed, memory-mappable by later stages).
+    	--compute_dvars ~ compute missing DVARS files from the BOLD image (dhcpy.bold_dvars) instead of skipping the session.
+    	--manifest ~ dataset manifest, indexes the fmri pipeline tree once and is updated incrementally in later runs
+    	    (read only in a sharded run, it must exist).
+    	--cache, --cache_size, --cache_hash ~ QC cache file, its size and whether inputs are identified by content hash (default: size and mtime).
+    	--sweep_iqr, --sweep_windows ~ sweep mode: scores every combination of IQR multiplier and window length, saves one table to <out>_sweep
+    	    (<out>.shard-<index>-of-<count>_sweep in a sharded run) and does not crop. --sweep_max_outliers: a session is
+    	    counted as retained if at most this fraction of its window are DVARS outliers (default 0.1).
+    	--traces ~ cohort trace store directory (dhcpy.build_traces): DVARS and FD traces of new sessions, and of sessions
+    	    whose tables changed, are added to it, and sessions are scored (and swept) from its memory-mapped arrays
+    	    instead of their tables.
+    	--store ~ also write the output table to a columnar results store directory.
+    	--profile ~ writes per-session stage timings, I/O counters and peak memory as json lines, and a summary table next to it.
+    	--shard_index, --shard_count ~ process one of shard_count deterministic subsets of the sessions, balanced by BOLD file size,
+    	    and write partial results to <out>.shard-<index>-of-<count>. Picked up from slurm/SGE job array variables by default.
+    	    --cache and --traces are refused in a sharded run, they are updated by every shard.
+    	--merge ~ merge mode: combines the results of this many shards into <out>, checking that no session was dropped or duplicated.
+    	--threshold_mode ~ subject (default): each session's own DVARS threshold. cohort: one threshold for all the sessions of the run,
+    	    stratum: one per age stratum (--strata_by, --strata_edges), estimated with mergeable quantile sketches
+    	    (dhcpy.cohort_thresholds) and saved to <out>_thresholds.csv. Cohort and stratum modes are not sharded.
+    	--window_mode ~ dvars (default): the retained window has the least DVARS outliers. joint: windows are also scored on
+    	    FD outliers (over --fd_threshold) and FD sum (dhcpy.joint_scores), lexicographically or by --window_weights.
+    	--watch ~ ingest mode: polls the fmri pipeline tree every this many seconds and scores and crops only the sessions
+    	    of the participants table whose inputs landed since the last poll, appending their rows to <out> (and --store).
+    	    Runs until interrupted, and picks up where it left in <out>. --settle: seconds input files must be unmodified,
+    	    --watch_batch: sessions scored and cropped at a time. Not combined with --threshold_mode cohort/stratum, --traces,
+    	    --cache, sharding, --merge or sweep mode.
+    	--journal ~ per-run journal (json lines) of started, completed (with checksums) and failed sessions. A restarted run
+    	    skips the sessions completed in it and redoes the rest; the output table is rebuilt from it. --journal_verify
+    	    checks the sha256 of completed outputs instead of their size.
+    	--prefetch_threads, --prefetch_depth, --crop_depth ~ reading, scoring and cropping run as a streaming pipeline: prefetch
+    	    threads read the tables of up to prefetch_depth upcoming sessions, and scoring waits while crop_depth crops are
+    	    pending, so memory stays bounded. --prefetch_depth 0 reads the tables in the scoring workers instead.
+    	--keep_vols, --bold_length ~ retained window and run lengths, in frames.
 """
 
 ########################################################################
 # Dependencies
 
-from dhcpy import *
-import pickle5 as pickle
+from dhcpy import (stage, prefetch, open_nifti, count, journal_write, journal_state, journal_done, journal_table, file_sha256, landed_sessions, dhcp_root, file_exists, read_trace, dvars_scores, joint_scores, censoring_sweep, sweep_summary,
+                   pad_traces, QuantileSketch, age_strata, cohort_thresholds, crop, bold_dvars, build_manifest,
+                   use_manifest, load_qc_cache, qc_cache_key, qc_cache_get, qc_cache_put, save_qc_cache,
+                   array_job_shard, shard_assignment, shard_root, write_shard, merge_shards, store_read, store_write, store_append,
+                   build_traces, trace_arrays, trace_rows, trace_sessions, trace_scores, enable_profiling,
+                   timed, profile_session, profile_summary)
+import os
+try:
+    import pickle5 as pickle
+except ImportError:
+    import pickle
 import multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 import pandas as pd
 import csv
 import numpy as np
 import argparse
+import sys
+import time
+import signal
 
 #########################################################################
 # Arguments and hard-coded (dataset-specific) parameteres
@@ -36,15 +86,119 @@ import argparse
 
 parser=argparse.ArgumentParser()
 parser.add_argument('--threads', type=int, default=48, help='number of threads to use')
-parser.add_argument('--in', type=str, default="./results/rel2_full", help='participants table to use as input')
+parser.add_argument('--crop_threads', type=int, default=4, help='number of sessions cropped at the same time')
+parser.add_argument('--in', type=str, default="./results/rel2_full", help='participants table to use as input (pickle root, or results store directory)')
 parser.add_argument('--out', type=str, default="./results/rel2_dvars", help='output pickle file path to pickle output-')
+parser.add_argument('--crop_method', type=str, default="native", choices=["native", "fsl"], help='crop in-process or with fslsplit/fslmerge')
+parser.add_argument('--crop_format', type=str, default="gz", choices=["gz", "bgz", "nii"], help='cropped image format: gzip, parallel block gzip or uncompressed')
+parser.add_argument('--gzip_threads', type=int, default=4, help='threads compressing each cropped image with --crop_format bgz')
+parser.add_argument('--compute_dvars', action='store_true', help='compute missing DVARS files from the BOLD image instead of skipping the session')
+parser.add_argument('--manifest', type=str, default=None, help='dataset manifest file, built or updated at start (see dhcpy.build_manifest)')
+parser.add_argument('--cache', type=str, default=None, help='QC cache file, sessions with unchanged inputs are not scored again')
+parser.add_argument('--cache_size', type=int, default=100000, help='maximum sessions kept in the QC cache')
+parser.add_argument('--cache_hash', action='store_true', help='identify cached inputs by content hash instead of size and mtime')
+parser.add_argument('--sweep_iqr', type=str, default=None, help='sweep mode: comma-separated IQR multipliers, e.g. 1,1.5,2')
+parser.add_argument('--sweep_windows', type=str, default=None, help='sweep mode: comma-separated window lengths, e.g. 1400,1600')
+parser.add_argument('--sweep_max_outliers', type=float, default=0.1, help='sweep mode: a session is retained if at most this fraction of its window are DVARS outliers')
+parser.add_argument('--traces', type=str, default=None, help='cohort trace store directory, updated with new sessions and scored from')
+parser.add_argument('--store', type=str, default=None, help='also write the output table to this columnar results store (see dhcpy.store_read)')
+parser.add_argument('--profile', type=str, default=None, help='json lines trace file of per-session stage timings, counters and peak memory')
+parser.add_argument('--shard_index', type=int, default=None, help='index of this shard (0-based), picked up from job array variables by default')
+parser.add_argument('--shard_count', type=int, default=None, help='amount of shards the sessions are split in')
+parser.add_argument('--merge', type=int, default=None, help='merge mode: combine the results of this many shards into the output table')
+parser.add_argument('--threshold_mode', type=str, default="subject", choices=["subject", "cohort", "stratum"], help='DVARS threshold of each session, its cohort or its age stratum')
+parser.add_argument('--strata_by', type=str, default="scan_age", choices=["scan_age", "birth_age"], help='age of the strata in stratum threshold mode')
+parser.add_argument('--strata_edges', type=str, default="37,40,42", help='comma-separated age (weeks) edges of the strata')
+parser.add_argument('--window_mode', type=str, default="dvars", choices=["dvars", "joint"], help='choose the retained window on DVARS, or on DVARS and FD')
+parser.add_argument('--fd_threshold', type=float, default=0.5, help='framewise displacement (mm) of an FD outlier in joint window mode')
+parser.add_argument('--window_weights', type=str, default=None, help='joint window mode: comma-separated weights of DVARS outliers, FD outliers and FD sum, lexicographic by default')
+parser.add_argument('--watch', type=float, default=None, help='ingest mode: poll the tree for new sessions every this many seconds')
+parser.add_argument('--settle', type=float, default=60, help='ingest mode: seconds input files must be unmodified before a session is queued')
+parser.add_argument('--watch_batch', type=int, default=32, help='ingest mode: sessions scored and cropped at a time')
+parser.add_argument('--journal', type=str, default=None, help='journal file of the run, a restarted run resumes from it')
+parser.add_argument('--journal_verify', action='store_true', help='check the sha256 of the outputs of completed sessions when resuming')
+parser.add_argument('--prefetch_threads', type=int, default=4, help='threads reading the tables of upcoming sessions')
+parser.add_argument('--prefetch_depth', type=int, default=16, help='sessions read ahead of scoring, 0 reads them in the scoring workers')
+parser.add_argument('--crop_depth', type=int, default=8, help='crops pending before scoring waits')
+parser.add_argument('--keep_vols', type=int, default=1600, help='length of the retained window of frames')
+parser.add_argument('--bold_length', type=int, default=2299, help='length of the BOLD run in frames')
 
 # Assign parsed variables
 args=parser.parse_args()
 
 core_count = args.threads
-subjects_pkl = args.in
+crop_threads = args.crop_threads
+subjects_pkl = getattr(args, 'in') # 'in' is a python keyword
 subjects_dvars = args.out
+keep_vols = args.keep_vols
+BOLD_length = args.bold_length
+crop_method = args.crop_method
+crop_format = args.crop_format
+gzip_threads = args.gzip_threads
+compute_dvars = args.compute_dvars
+manifest_file = args.manifest
+cache_file = args.cache
+cache_size = args.cache_size
+cache_hash = args.cache_hash
+trace_dir = args.traces
+store_dir = args.store
+profile_file = args.profile
+merge_count = args.merge
+if args.shard_count is not None:
+    # the index of a task of a job array, unless given
+    shard_count = args.shard_count
+    shard_index = args.shard_index if args.shard_index is not None else (array_job_shard() or [None])[0]
+    if shard_index is None:
+        parser.error("--shard_count needs --shard_index outside a job array")
+elif args.shard_index is not None:
+    parser.error("--shard_index needs --shard_count")
+else:
+    shard_index, shard_count = array_job_shard() or [0, 1]
+if shard_count < 1 or not 0 <= shard_index < shard_count:
+    parser.error("shard index " + str(shard_index) + " is not in [0, " + str(shard_count) + ")")
+threshold_mode = args.threshold_mode
+# the thresholds are estimated from the sessions of the run, so a shard would use its own.
+if threshold_mode != "subject" and shard_count > 1 and not merge_count:
+    parser.error("--threshold_mode " + threshold_mode + " estimates thresholds from all the sessions of the run, "
+                 "it cannot be sharded (--shard_count 1, outside a job array)")
+# the QC cache and the trace store are rewritten by the run, shards would overwrite each other's updates.
+# The manifest is only read in a shard, build it before the job array (e.g. with an unsharded run).
+if shard_count > 1 and not merge_count:
+    for option, value in [['--cache', cache_file], ['--traces', trace_dir]]:
+        if value:
+            parser.error(option + " is shared state updated by the run, it cannot be sharded")
+    if manifest_file and not os.path.exists(manifest_file):
+        parser.error("--manifest must be built before a sharded run, " + manifest_file + " does not exist")
+strata_by = args.strata_by
+strata_edges = [float(x) for x in args.strata_edges.split(',')]
+# joint window parameters (see dhcpy.joint_scores), None in dvars window mode
+joint = None
+if args.window_mode == "joint":
+    joint = {'fd_threshold': args.fd_threshold,
+             'weights': [float(x) for x in args.window_weights.split(',')] if args.window_weights else None}
+watch_interval = args.watch
+settle = args.settle
+watch_batch = args.watch_batch
+journal_file = args.journal
+journal_verify = args.journal_verify
+prefetch_threads = args.prefetch_threads
+prefetch_depth = args.prefetch_depth
+crop_depth = args.crop_depth
+sweep = args.sweep_iqr is not None or args.sweep_windows is not None
+sweep_max_outliers = args.sweep_max_outliers
+sweep_iqr = [float(x) for x in args.sweep_iqr.split(',')] if args.sweep_iqr else [1.5]
+sweep_windows = [int(x) for x in args.sweep_windows.split(',')] if args.sweep_windows else [keep_vols]
+# ingest mode only scores (subject thresholds) and crops the sessions as they land
+if watch_interval:
+    unsupported = [['--threshold_mode ' + threshold_mode, threshold_mode != "subject"], ['--traces', trace_dir],
+                   ['--cache', cache_file], ['sharding', shard_count > 1], ['--merge', merge_count], ['sweep mode', sweep]]
+    for option, used in unsupported:
+        if used:
+            parser.error("--watch does not support " + option)
+
+# columns of the output table
+output_columns = ['participant_id', 'singleton', 'birth_age', 'sex', 'birth_weight', 'session_id', 'scan_age',
+                  'scan_number', 'dvars_outliers', 'mean_dvars', 'start_best_interval', 'mean_fd']
 
 # DHCP Paths
 funcdir = dhcp_root() + "/dhcp_fmri_pipeline" # dhcp_root() is a function of dhcpy
@@ -54,176 +208,510 @@ anatdir = dhcp_root() + "/dhcp_anat_pipeline"
 # Parallelization functions and main thread
 
 
-# Participants table to pandas
-with open(subjects_pkl + '.pkl', "rb") as fh:
-  subjects = pickle.load(fh)
+####
+# per-session workers
 
+# (participant_id, session_id): DVARS threshold in cohort and stratum threshold modes,
+# set before the scoring pool starts, its workers inherit it (or get it from init_scoring_worker).
+dvars_thresholds = dict()
 
-####
-# main dvars function
-def dvars(csvfile):
+# (participant_id, session_id) with unfinished journal records (started or failed): cropped again, not skipped
+# as already cropped. Set before the cropping pool starts.
+journal_unfinished = set()
 
+def session_paths(subid, sesid):
     '''
-	 dvars: calculates the interval of minimum amount of frames over the DVARS threshold as explained in Eyre et al., 2022. Returns the amount of frames over the threshold, the index where the interval starts, and the mean dvars over the whole run. 
-	 
-	 Input: The previously generated csvfile of a single subject's dvars as input (see fsl_motion_outliers).
-	 
-         returns the rating and location of subjects 1600 best volumes
-         returns -1 if the csvfile cannot be found.
+     session_paths: dhcp canonical paths of the motion table, DVARS table and BOLD image of a session.
     '''
-    
-    # if file does not exist, return -1
-    if not os.path.exists(csvfile):
-        print(csvfile)
-        return -1
-    else:
-        # else, open csv file as pandas and format correctly
-        subject_dvars = csv2pd(csvfile)
-        subject_dvars = subject_dvars.astype(float)
-        # save mean dvars over all the frames
-        mean_dvars = np.mean(subject_dvars[1:])[0]
-        
-        # definition of motion outlier **for dhcp 2nd release, you may need to change this**
-        min_volsOver = 1600
-        keep_vols = 1600
-        BOLD_length = 2299
-       
-        # definition of threshold as > 1.5 IQR over 75th percentile of each subject's DVARS. 
-        threshold = 1.5 * stats.iqr(subject_dvars[1:]) + np.percentile(subject_dvars[1:], 75)
-
-        # Intialize index of lowest motion interval
-        min_idx = 0
-        for i in range (BOLD_length-keep_vols):
-            # Intialize value of lowest motion interval at 1600
-            previous_min = min_volsOver
-            # if the moving window contains less than 1600 motion outlier frames, keep it
-            min_volsOver = min(min_volsOver, np.count_nonzero(subject_dvars[i:i+keep_vols] > threshold))
-            # if the value was not kept, also save the new index of the window.
-            if previous_min != min_volsOver:
-                    min_idx = i
-    return [min_volsOver, min_idx, mean_dvars]
-    
-####
-# main crop function 
+    session_path = funcdir + "/sub-" + subid + "/ses-" + sesid + '/func/sub-' + subid + '_ses-' + sesid
+    return [session_path + '_motion.tsv', session_path + 'DVARS.csv', session_path + '_task-rest_desc-preproc_bold.nii.gz']
 
-def crop(subid, sesid, start, period_length = 1600):
+def cache_key(participant):
     '''
-	 crop: crops BOLD timeseries from the DHCP subject subid session sesid from index start and for period_length.
-	 Saves in canonical DHCP 2nd release paths.
+     cache_key: QC cache key of a session, from its input files and the censoring parameters.
     '''
-    
-    from shutil import rmtree
-    from tempfile import TemporaryDirectory
-    
-    # original preprocessed BOLD nifti.
-    bold = funcdir + '/sub-' + subid + "/ses-" + sesid + '/func/sub-' + subid + '_ses-' + sesid + '_task-rest_desc-preproc_bold.nii.gz'
-    # temporal directory for splitting operation
-    dir_split = tempfile.TemporaryDirectory().name + '/' + subid + "_sesid-" + sesid + '/' # /geode2/home/u020/dderman/Carbonate/dHCP_dataset/temp for the author
-    # make temporary directory
-    os.makedirs(dir_split, exist_ok=True)
-    # name root of splited volumes
-    fsplit = dir_split + 'vol_'
-    # make output canonical directory
-    dir_cropped = dhcp_root() + "/dhcp_fmri_cropped/" + subid
-    os.makedirs(dir_cropped, exist_ok=True)
-    # ouput filename
-    fcropped = dir_cropped + "/" + subid + "_ses-" + sesid + "_task-rest_desc-cropped_bold.nii.gz"
-    
-    # If not previously cropped
-    if not os.path.exists(fcropped):
-        print("Scrubbing " + subid)
-
-        # If it has not been split before
-        if not os.path.exists(dir_split + "vol_2000.nii.gz"):
-            print("Starting splitting at " + dir_split)
-            # FSLSPLIT
-            os.system('fslsplit ' + bold + " " + fsplit)
-            
-        # Start merging section
-        # This little function adds zero padding to the name of each split volume.
-        def add_prestr(n):
-            return fsplit + str(n).zfill(4) + '.nii.gz'
-        
-        # range of indices to save
-        vol_range = list()
-        vol_range.extend(range(start, start + period_length))
-        aux = map(add_prestr, vol_range)
-        
-        # start writing shell command for FSLMERGE
-        # fslmerge -t output_fname [splitted volumes] 
-        command_list = list(aux)
-        command_list.insert(0, fcropped)
-        command_list.insert(0, "-t")
-        command_list.insert(0, "fslmerge")
-        # run shell command FSLSPLIT
-        process = subprocess.Popen(command_list, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        stdout, stderr = process.communicate()
-        print(stdout)
-        print(stderr)
-        
-        # When finished, delete temp files.
-        print("Delete temp files for " + subid)
-        rmtree(dir_split, ignore_errors=True)
+    fd_path, dvars_path, bold_path = session_paths(participant['participant_id'], str(participant['session_id']))
+    # without a DVARS file, the scores come from the BOLD image.
+    inputs = [fd_path, dvars_path if file_exists(dvars_path) else bold_path]
+    params = {'keep_vols': keep_vols, 'BOLD_length': BOLD_length, 'iqr_factor': 1.5,
+              'threshold': dvars_thresholds.get((participant['participant_id'], str(participant['session_id']))),
+              'joint': joint}
+    return qc_cache_key(inputs, params, cache_hash)
 
-####
-# main thread
+def load_session(participant):
+    '''
+     load_session: I/O part of score_session. Reads the motion and DVARS tables of one session, and the BOLD
+     header so that it is cached for the crop. Runs in the prefetch threads.
+
+     returns [participant, traces, error]. traces is [fd, dvars], dvars None if it is computed from the BOLD image
+     when scored, or None if the session failed, with the reason in error.
+    '''
+    subid = participant['participant_id']
+    sesid = str(participant['session_id'])
+    try:
+        with profile_session(subid, sesid, 'load'):
+            # dhcp canonical paths
+            fd_path, dvars_path, bold_path = session_paths(subid, sesid)
+            # the DVARS file must have been previously created (see fsl_motion_outliers), or be computed when scored.
+            if not file_exists(dvars_path) and not compute_dvars:
+                return [participant, None, "dvars does not exist. sub: " + subid + " ses: " + sesid]
+            subject_fd = read_trace(fd_path, 'framewise_displacement')
+            subject_dvars = read_trace(dvars_path) if file_exists(dvars_path) else None
+            if file_exists(bold_path):
+                with open_nifti(bold_path) as fh:
+                    count('bytes_read', len(fh.read(352)))
+            return [participant, [subject_fd, subject_dvars], None]
+    except Exception as e:
+        return [participant, None, "scoring failed. sub: " + subid + " ses: " + sesid + " (" + repr(e) + ")"]
 
-# initialize rows of final table
-rows = list()
+def score_loaded(loaded):
+    '''
+     score_loaded: CPU part of score_session. Scores the DVARS outlier interval of a session read by load_session.
 
-for participant in subjects.iterrows():
-    # get first list of the row (format)
-    participant=participant[1]
-    # get participant information for paths
+     returns [qc, error], as score_session.
+    '''
+    participant, traces, error = loaded
+    if error is not None:
+        return [None, error]
     subid = participant['participant_id']
     sesid = str(participant['session_id'])
-    # dhcp canonical paths
-    session_path = funcdir + "/sub-" + subid + "/ses-" + sesid
-    fd_path = session_path + '/func/sub-' + subid + '_ses-' + sesid + '_motion.tsv'
-    subject_fd = csv2pd(fd_path)
-    subject_fd = subject_fd.astype(float)
-    # calculate mean framewise displacement for the subject.
-    mean_fd = subject_fd['framewise_displacement'].mean()
-    # if the DVARS file was previously created, then calculate DVARS outlier interval.
-    if os.path.exists(session_path + '/func/sub-' + subid + '_ses-' + sesid + 'DVARS.csv'):
-        # dvars main function
-        vols_dvars, index_dvars, mean_dvars = dvars(session_path + '/func/sub-' + subid + '_ses-' + sesid + 'DVARS.csv')
-        
-        # append subject data and output of dvars to the final table.
-        rows.append({'participant_id': subid,
-                     'singleton': participant['singleton'],
-                     'birth_age': float(participant['birth_age']),
-                     'sex': participant['sex'],
-                     'birth_weight': float(participant['birth_weight']),
-                     'session_id': participant['session_id'],
-                     'scan_age': float(participant['scan_age']),
-                     'scan_number': int(participant['scan_number']),
-                     'dvars_outliers': vols_dvars,
-                     'mean_dvars': mean_dvars,
-                     'start_best_interval': index_dvars,
-                     'mean_fd': mean_fd
-                     })
+    try:
+        with profile_session(subid, sesid, 'score'):
+            subject_fd, subject_dvars = traces
+            if subject_dvars is None:
+                # DVARS from the BOLD image, saved for later runs. Scored as dvars() reads the
+                # saved file back, read_trace takes its first line as the header.
+                fd_path, dvars_path, bold_path = session_paths(subid, sesid)
+                subject_dvars = bold_dvars(bold_path, csvfile=dvars_path)[1:]
+            threshold = dvars_thresholds.get((subid, sesid))
+            # window search, see dhcpy.dvars_scores and dhcpy.joint_scores (vectorized)
+            with timed('dvars'):
+                if joint is None:
+                    vols_dvars, index_dvars, mean_dvars = dvars_scores(subject_dvars, keep_vols, BOLD_length,
+                                                                       threshold=threshold)
+                else:
+                    vols_dvars, _, _, index_dvars, mean_dvars = joint_scores(subject_dvars, subject_fd, keep_vols, BOLD_length,
+                                                                             fd_threshold=joint['fd_threshold'],
+                                                                             weights=joint['weights'], threshold=threshold)
+
+            # mean framewise displacement for the subject.
+            qc = {'dvars_outliers': int(vols_dvars),
+                  'mean_dvars': float(mean_dvars),
+                  'start_best_interval': int(index_dvars),
+                  'mean_fd': float(subject_fd.mean())
+                  }
+            return [qc, None]
+    except Exception as e:
+        return [None, "scoring failed. sub: " + subid + " ses: " + sesid + " (" + repr(e) + ")"]
+
+def init_scoring_worker(thresholds, profile):
+    '''
+     init_scoring_worker: initializer of the spawned scoring workers of the streaming pipeline. They are not forked
+     (the prefetch and crop threads are running by then), so they get the state set by the main thread here.
+    '''
+    dvars_thresholds.update(thresholds)
+    if profile:
+        enable_profiling(profile)
+
+def score_session(participant):
+    '''
+     score_session: reads the motion and DVARS tables of one session and scores its DVARS outlier interval
+     (load_session, then score_loaded). Runs in the scoring pool, errors are caught so that one broken
+     session does not stop the run.
+
+     Input: participant, a dictionary with a row of the participants table.
+
+     returns [qc, error]. qc is a dictionary with the QC results of the session, or None if the session failed,
+     with the reason in error.
+    '''
+    return score_loaded(load_session(participant))
+
+def session_row(participant, qc):
+    '''
+     session_row: subject data and output of dvars for the final table.
+    '''
+    return {'participant_id': participant['participant_id'],
+            'singleton': participant['singleton'],
+            'birth_age': float(participant['birth_age']),
+            'sex': participant['sex'],
+            'birth_weight': float(participant['birth_weight']),
+            'session_id': participant['session_id'],
+            'scan_age': float(participant['scan_age']),
+            'scan_number': int(participant['scan_number']),
+            'dvars_outliers': qc['dvars_outliers'],
+            'mean_dvars': qc['mean_dvars'],
+            'start_best_interval': qc['start_best_interval'],
+            'mean_fd': qc['mean_fd']
+            }
+
+def load_dvars(participant):
+    '''
+     load_dvars: DVARS trace of a session as scored by dvars(), None if it does not exist.
+    '''
+    dvars_path = session_paths(participant['participant_id'], str(participant['session_id']))[1]
+    if not file_exists(dvars_path):
+        return None
+    return read_trace(dvars_path)
+
+def session_sketch(participant):
+    '''
+     session_sketch: quantile sketch of a session's DVARS trace (first frame left out, as in dvars()),
+     None if it does not exist. Runs in the pool, only the small sketch goes back.
+    '''
+    trace = load_dvars(participant)
+    return None if trace is None else QuantileSketch().update(trace[1:])
+
+def set_thresholds(participants):
+    '''
+     set_thresholds: cohort or stratum DVARS thresholds of the sessions (see threshold_mode), from one
+     pass over their traces merging per-session sketches. Saves the thresholds table to <out>_thresholds.csv.
+    '''
+    if trace_dir:
+        rows = trace_rows(trace_dir, [[participant['participant_id'], participant['session_id']] for participant in participants])
+        lengths = trace_sessions(trace_dir)['dvars_frames'].to_numpy()[rows]
+        dvars_array = trace_arrays(trace_dir, ['dvars'])['dvars']
+        sketches = [QuantileSketch().update(dvars_array[row, 1:length]) if length > 0 else None
+                    for row, length in zip(rows, lengths)]
     else:
-        print("warning: dvars does not exist. sub: " + subid)
-        
-        
-    ##
-    # As next step, crop BOLD session
-    crop(subid, participant['session_id'], index_dvars)
-        
-# discard first (empty) row.
-rows.pop(0)
+        with mp.Pool(core_count) as pool:
+            sketches = pool.map(session_sketch, participants, chunksize=4)
+    found = [i for i, sketch in enumerate(sketches) if sketch is not None]
+    strata = None
+    if threshold_mode == "stratum":
+        strata = age_strata([float(participants[i][strata_by]) for i in found], strata_edges)
+    groups = cohort_thresholds([sketches[i] for i in found], strata)[1]
+    print(groups.to_string())
+    groups.to_csv(subjects_dvars + '_thresholds.csv')
+    threshold_of = dict(zip(groups['stratum'], groups['threshold']))
+    for j, i in enumerate(found):
+        stratum = strata[j] if strata is not None else 'cohort'
+        dvars_thresholds[(participants[i]['participant_id'], str(participants[i]['session_id']))] = float(threshold_of[stratum])
 
-# tidy final table
-subjects_out = pd.DataFrame(rows, columns=['participant_id', 'singleton', 'birth_age', 'sex', 'birth_weight',
-                                           'session_id', 'scan_age', 'scan_number', 'dvars_outliers', 'mean_dvars',
-                                           'start_best_interval', 'mean_fd'])
+def run_sweep(participants):
+    '''
+     run_sweep: sweep mode, loads each session's DVARS once and scores the whole grid of
+     IQR multipliers and window lengths (see dhcpy.censoring_sweep).
+    '''
+    if trace_dir:
+        rows = trace_rows(trace_dir, [[participant['participant_id'], participant['session_id']] for participant in participants])
+        lengths = trace_sessions(trace_dir)['dvars_frames'].to_numpy()[rows]
+        dvars_array = trace_arrays(trace_dir, ['dvars'])['dvars']
+        traces = [dvars_array[row, :length] if length > 0 else None for row, length in zip(rows, lengths)]
+    else:
+        with mp.Pool(core_count) as pool:
+            traces = pool.map(load_dvars, participants, chunksize=4)
+    found = [i for i, trace in enumerate(traces) if trace is not None]
+    print(str(len(participants) - len(found)) + " sessions without dvars skipped.")
+    subjects = [participants[i]['participant_id'] + '_ses-' + str(participants[i]['session_id']) for i in found]
+    table = censoring_sweep(pad_traces([traces[i] for i in found]), sweep_iqr, sweep_windows, BOLD_length,
+                            sweep_max_outliers, subjects)
+    print(sweep_summary(table))
+    # each shard of a job array writes its own sweep table
+    sweep_root = shard_root(subjects_dvars, shard_index, shard_count) if shard_count > 1 else subjects_dvars
+    table.to_pickle(sweep_root + '_sweep.pkl')
+    table.to_csv(sweep_root + '_sweep.csv')
+
+def crop_session(row):
+    '''
+     crop_session: crops the BOLD session of an output table row. Runs in the cropping pool.
+
+     Recorded in the journal, if any: started, then done with the row and the cropped image, or failed.
+
+     returns None, or the reason if cropping failed.
+    '''
+    session = {'participant_id': row['participant_id'], 'session_id': row['session_id']}
+    try:
+        if journal_file:
+            journal_write(journal_file, dict(session, status='started'))
+        with profile_session(row['participant_id'], row['session_id'], 'crop'):
+            fcropped = crop(row['participant_id'], str(row['session_id']), int(row['start_best_interval']), keep_vols,
+                            crop_method, crop_format, gzip_threads,
+                            overwrite=(row['participant_id'], str(row['session_id'])) in journal_unfinished)
+        if journal_file:
+            journal_write(journal_file, dict(session, status='done', row=row, output=fcropped,
+                                             size=os.path.getsize(fcropped), sha256=file_sha256(fcropped)))
+    except Exception as e:
+        error = "crop failed. sub: " + row['participant_id'] + " ses: " + str(row['session_id']) + " (" + repr(e) + ")"
+        if journal_file:
+            journal_write(journal_file, dict(session, status='failed', error=error))
+        return error
+
+def read_participants():
+    '''
+     read_participants: participants table, from a results store or a pickle.
+    '''
+    if os.path.isdir(subjects_pkl):
+        return store_read(subjects_pkl)
+    with open(subjects_pkl + '.pkl', "rb") as fh:
+        return pickle.load(fh)
+
+def input_mtimes(participant):
+    '''
+     input_mtimes: modification times of the input files of a session, to retry failed sessions when they change.
+    '''
+    return tuple(os.stat(path).st_mtime if os.path.exists(path) else None
+                 for path in session_paths(participant['participant_id'], str(participant['session_id'])))
+
+def ingest(batch, score_pool, crop_pool):
+    '''
+     ingest: scores and crops a batch of sessions on the pools.
+
+     returns [rows, failed]: the output rows of the sessions scored and cropped, and the failed sessions.
+    '''
+    rows = list()
+    failed = list()
+    crop_jobs = list()
+    for participant, [qc, error] in zip(batch, score_pool.imap(score_session, batch)):
+        if error is not None:
+            print("warning: " + error)
+            failed.append(participant)
+            if journal_file:
+                journal_write(journal_file, {'participant_id': participant['participant_id'],
+                                             'session_id': participant['session_id'], 'status': 'failed', 'error': error})
+            continue
+        row = session_row(participant, qc)
+        crop_jobs.append([participant, row, crop_pool.submit(crop_session, row)])
+    for participant, row, job in crop_jobs:
+        error = job.result()
+        if error is not None:
+            print("warning: " + error)
+            failed.append(participant)
+        else:
+            rows.append(row)
+    return [rows, failed]
+
+def watch():
+    '''
+     watch: ingest mode. Every watch_interval seconds, updates an in-memory manifest of the fmri pipeline tree
+     (only changed subjects are scanned again) and queues the sessions of the participants table whose inputs
+     landed (see dhcpy.landed_sessions) and are not in the output table yet. They are scored and cropped
+     watch_batch at a time on bounded pools, and their rows appended to the output table once cropped, so the
+     table lists the sessions ready for the next stages. Failed sessions are retried when their inputs change.
+     Runs until interrupted.
+    '''
+    participants_file = subjects_pkl if os.path.isdir(subjects_pkl) else subjects_pkl + '.pkl'
+    if os.path.exists(subjects_dvars + '.pkl'):
+        table = pd.read_pickle(subjects_dvars + '.pkl')
+    else:
+        table = pd.DataFrame(columns=output_columns)
+    done = set(zip(table['participant_id'], table['session_id'].astype(str)))
+    print(str(len(done)) + " sessions already in " + subjects_dvars + '.pkl')
+    failed = dict()
+    index = None
+    participants_mtime = None
+    # Ctrl-C stops the main process only, the workers ignore it and the pools are closed on the way out.
+    try:
+        with mp.Pool(core_count, initializer=signal.signal, initargs=(signal.SIGINT, signal.SIG_IGN)) as score_pool, \
+                ThreadPoolExecutor(crop_threads) as crop_pool:
+            while True:
+                # participants table, read again when it changes
+                if os.stat(participants_file).st_mtime != participants_mtime:
+                    participants_mtime = os.stat(participants_file).st_mtime
+                    by_session = {(participant['participant_id'], str(participant['session_id'])): participant
+                                  for participant in read_participants().to_dict('records')}
+                index = build_manifest(manifest_file=manifest_file, pipelines=("dhcp_fmri_pipeline",), previous=index)
+                landed = landed_sessions(index, done, settle, compute_dvars)
+                queue = [by_session[session] for session in landed if session in by_session
+                         and failed.get(session) != input_mtimes(by_session[session])]
+                if queue:
+                    print(time.strftime('%Y-%m-%d %H:%M:%S') + ": " + str(len(queue)) + " new sessions.")
+                for batch in range(0, len(queue), watch_batch):
+                    rows, batch_failed = ingest(queue[batch:batch + watch_batch], score_pool, crop_pool)
+                    for participant in batch_failed:
+                        failed[(participant['participant_id'], str(participant['session_id']))] = input_mtimes(participant)
+                    if rows:
+                        new_rows = pd.DataFrame(rows, columns=output_columns)
+                        table = pd.concat([table, new_rows], ignore_index=True) if len(table) else new_rows
+                        table.to_pickle(subjects_dvars + '.pkl')
+                        table.to_csv(subjects_dvars + '.csv')
+                        if store_dir:
+                            store_append(store_dir, new_rows)
+                        done.update((row['participant_id'], str(row['session_id'])) for row in rows)
+                    print(str(len(rows)) + " sessions ready, " + str(len(batch_failed)) + " failed.")
+                time.sleep(watch_interval)
+    except KeyboardInterrupt:
+        print("Stopped watching, " + str(len(table)) + " sessions in " + subjects_dvars + '.pkl')
+
+####
+# main thread
+
+if __name__ == '__main__':
+
+    if profile_file:
+        enable_profiling(profile_file)
+
+    # the workers of ingest mode check the filesystem, the tree changes while it runs.
+    if watch_interval:
+        watch()
+        sys.exit(0)
+
+    # index the fmri tree once, the pool workers inherit it.
+    if manifest_file and shard_count > 1:
+        use_manifest(manifest_file)
+    elif manifest_file:
+        use_manifest(build_manifest(manifest_file=manifest_file, pipelines=("dhcp_fmri_pipeline",)))
+
+    # Participants table to pandas, from a results store or a pickle
+    subjects = read_participants()
+    participants = subjects.to_dict('records')
 
-# Save in pkl and csv on subject_dvars
-subjects_out.to_pickle(subjects_dvars + '.pkl')
-subjects_out.to_csv(subjects_dvars + '.csv')
+    if merge_count:
+        subjects_out, failed = merge_shards(subjects_dvars, merge_count, subjects)
+        print(str(len(subjects_out)) + " sessions merged from " + str(merge_count) + " shards, " + str(len(failed)) + " failed.")
+        subjects_out.to_pickle(subjects_dvars + '.pkl')
+        subjects_out.to_csv(subjects_dvars + '.csv')
+        if store_dir:
+            store_write(store_dir, subjects_out)
+        sys.exit(0)
 
+    # this shard's sessions, balanced by expected file size
+    positions = list(range(len(participants)))
+    if shard_count > 1:
+        sizes = [os.path.getsize(bold) if os.path.exists(bold) else 0
+                 for bold in (session_paths(participant['participant_id'], str(participant['session_id']))[2]
+                              for participant in participants)]
+        assignment = shard_assignment(sizes, shard_count)
+        positions = [i for i in positions if assignment[i] == shard_index]
+        participants = [participants[i] for i in positions]
+        print("shard " + str(shard_index) + " of " + str(shard_count) + ": " + str(len(participants)) + " sessions.")
 
+    if trace_dir:
+        appended = build_traces(trace_dir, pd.DataFrame(participants, columns=subjects.columns), core_count)
+        print(str(appended) + " sessions added to the trace store.")
 
+    if sweep:
+        run_sweep(participants)
+        sys.exit(0)
+
+    if threshold_mode != "subject":
+        set_thresholds(participants)
+
+    # initialize rows of final table
+    rows = list()
+    errors = list()
+    failed = list()
+
+    # sessions completed in the journal of a previous run are neither scored nor cropped again.
+    todo = participants
+    if journal_file:
+        state = journal_state(journal_file)
+        todo = [participant for participant in participants
+                if not journal_done(state.get((participant['participant_id'], str(participant['session_id']))), journal_verify)]
+        journal_unfinished.update((participant['participant_id'], str(participant['session_id'])) for participant in todo
+                                  if (participant['participant_id'], str(participant['session_id'])) in state)
+        print(str(len(participants) - len(todo)) + " sessions completed in the journal, " + str(len(todo)) + " to do.")
+
+    # QC results of unchanged sessions come from the cache, only the rest are scored.
+    cache = load_qc_cache(cache_file, cache_size) if cache_file else None
+    keys = [None] * len(todo)
+    cached = [None] * len(todo)
+    if cache is not None:
+        keys = [cache_key(participant) for participant in todo]
+        cached = [qc_cache_get(cache, key) for key in keys]
+        print(str(len(todo) - cached.count(None)) + " sessions found in the QC cache.")
+    # the trace store scores the rest in one pass, sessions without traces go to score_session.
+    from_traces = [None] * len(todo)
+    if trace_dir:
+        pending = [i for i, qc in enumerate(cached) if qc is None]
+        scores = trace_scores(trace_dir, [[todo[i]['participant_id'], todo[i]['session_id']] for i in pending],
+                              keep_vols, BOLD_length,
+                              threshold=None if threshold_mode == "subject" else
+                              [dvars_thresholds.get((todo[i]['participant_id'], str(todo[i]['session_id'])), np.nan)
+                               for i in pending],
+                              joint=joint)
+        for i, score in zip(pending, scores.to_dict('records')):
+            if score['dvars_frames'] > 0 and score['fd_frames'] > 0:
+                from_traces[i] = {'dvars_outliers': int(score['dvars_outliers']),
+                                  'mean_dvars': float(score['mean_dvars']),
+                                  'start_best_interval': int(score['start_best_interval']),
+                                  'mean_fd': float(score['mean_fd'])}
+    to_score = [participant for participant, qc, trace_qc in zip(todo, cached, from_traces)
+                if qc is None and trace_qc is None]
+
+    # Scoring is CPU-bound and runs in a process pool, cropping waits on FSL and the
+    # filesystem and runs in its own, smaller, thread pool. Sessions are cropped as soon
+    # as they are scored. Both keep the order of the participants table.
+    # With prefetch, the tables are read by threads ahead of the scoring pool, which has
+    # at most 2 sessions per worker in flight (see dhcpy.stage), and scoring waits while
+    # crop_depth crops are pending: each stage only runs a bounded amount ahead.
+    # The executor starts its workers on demand, when threads already run, so they are spawned instead
+    # of forked (a forked child can inherit a lock held by another thread); mp.Pool forks them all here.
+    if prefetch_depth:
+        score_pool = ProcessPoolExecutor(core_count, mp_context=mp.get_context('spawn'),
+                                         initializer=init_scoring_worker, initargs=(dvars_thresholds, profile_file))
+    else:
+        score_pool = mp.Pool(core_count)
+    with score_pool, \
+            ThreadPoolExecutor(crop_threads) as crop_pool:
+        crop_jobs = list()
+        cropping = set()
+        if prefetch_depth:
+            loaded = prefetch(load_session, to_score, prefetch_threads, prefetch_depth)
+            scored = stage(score_loaded, loaded, score_pool if core_count > 1 else None, 2 * core_count)
+        else:
+            scored = score_pool.imap(score_session, to_score, chunksize=4)
+        for participant, key, qc, trace_qc in zip(todo, keys, cached, from_traces):
+            if qc is None and trace_qc is not None:
+                qc = trace_qc
+                if cache is not None:
+                    qc_cache_put(cache, key, qc)
+            elif qc is None:
+                qc, error = next(scored)
+                if error is not None:
+                    print("warning: " + error)
+                    errors.append(error)
+                    failed.append([participant['participant_id'], participant['session_id']])
+                    if journal_file:
+                        journal_write(journal_file, {'participant_id': participant['participant_id'],
+                                                     'session_id': participant['session_id'], 'status': 'failed',
+                                                     'error': error})
+                    continue
+                if cache is not None:
+                    qc_cache_put(cache, key, qc)
+            row = session_row(participant, qc)
+            ##
+            # As next step, crop BOLD session. Its row goes to the table once cropped.
+            crop_jobs.append([participant, row, crop_pool.submit(crop_session, row)])
+            if prefetch_depth:
+                cropping.add(crop_jobs[-1][2])
+                if len(cropping) >= crop_depth:
+                    cropping = wait(cropping, return_when=FIRST_COMPLETED)[1]
+
+        for participant, row, job in crop_jobs:
+            error = job.result()
+            if error is not None:
+                print("warning: " + error)
+                errors.append(error)
+                failed.append([participant['participant_id'], participant['session_id']])
+            else:
+                rows.append(row)
+
+    print(str(len(rows)) + " sessions scored and cropped, " + str(len(errors)) + " errors.")
+    if cache is not None:
+        save_qc_cache(cache)
+    if profile_file:
+        summary = profile_summary(profile_file)
+        print(summary.to_string())
+        summary.to_csv(profile_file + '.summary.csv')
+
+    # tidy final table, from the journal if any so that it includes the sessions of previous runs
+    if journal_file:
+        subjects_out = journal_table(journal_file, [[participant['participant_id'], participant['session_id']]
+                                                    for participant in participants], output_columns)
+        done = set(zip(subjects_out['participant_id'], subjects_out['session_id'].astype(str)))
+        failed = [[participant['participant_id'], participant['session_id']] for participant in participants
+                  if (participant['participant_id'], str(participant['session_id'])) not in done]
+    else:
+        subjects_out = pd.DataFrame(rows, columns=output_columns)
 
+    # partial results of a shard, see --merge
+    if shard_count > 1:
+        assigned = [[participant['participant_id'], participant['session_id']] for participant in participants]
+        write_shard(subjects_dvars, shard_index, shard_count, subjects_out, positions, assigned, failed)
+        sys.exit(0)
 
+    # Save in pkl and csv on subject_dvars
+    subjects_out.to_pickle(subjects_dvars + '.pkl')
+    subjects_out.to_csv(subjects_dvars + '.csv')
+    if store_dir:
+        store_write(store_dir, subjects_out)
@@ -1,18 +1,75 @@
 import os
 import csv
-import pandas as pd
-import numpy as np
-from scipy import stats
+import gzip
+import tempfile
+from shutil import rmtree
+import importlib
 from socket import gethostname
 import subprocess
-from socket import gethostname
-import pickle5 as pickle
+import json
+import re
+import hashlib
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
+import threading
+import functools
+import time
+try:
+    import pickle5 as pickle
+except ImportError:
+    import pickle
 
 '''
 Python tools for processing the dHCP dataset. Most functions 
 would also be useful for any other fsl pipeline.
 '''
 
+__all__ = [
+    # hosts and paths
+    'get_host', 'init_host', 'dhcp_root', 'is_number', 'get_niftiPath', 'session_files', 'get_sessions',
+    'get_scanage', 'get_sesid', 'generate_fullpaths', 'file_exists',
+    # profiling
+    'enable_profiling', 'disable_profiling', 'count', 'timed', 'profiled', 'reset_peak_rss', 'peak_rss_mb', 'profile_session',
+    'profile_summary',
+    # tables and queries
+    'success_report', 'is_multisession', 'filter_by', 'QUERY_ALIASES', 'compile_query', 'join_qc', 'query',
+    'read_table', 'read_trace', 'read_tables', 'csv2dict', 'csv2pd',
+    # DVARS and motion censoring
+    'dvars_threshold', 'prefix_counts', 'window_counts', 'min_window', 'best_window', 'dvars_scores',
+    'WINDOW_CRITERIA', 'joint_scores', 'censoring_sweep', 'sweep_summary', 'pad_traces', 'dvars',
+    'QuantileSketch', 'sketch_threshold', 'age_strata', 'cohort_thresholds',
+    'longest_runs', 'longest_streak', 'streak_table', 'get_longeststreak',
+    # images
+    'BlockGzipWriter', 'open_nifti', 'crop_nifti', 'crop_fsl', 'CROP_FORMATS', 'cropped_path', 'crop',
+    'bold_chunks', 'bold_dvars', 'bold_image_stats', 'fslstats_mean_sd_range', 'boldstats', 'call_job',
+    'stage', 'prefetch',
+    # manifest, QC cache and shards
+    'build_manifest', 'use_manifest', 'manifest_subject', 'landed_sessions', 'load_qc_cache', 'qc_cache_key', 'qc_cache_get',
+    'qc_cache_put', 'save_qc_cache', 'journal_write', 'journal_state', 'file_sha256', 'journal_done', 'journal_table', 'array_job_shard', 'shard_assignment', 'shard_root', 'write_shard', 'merge_shards',
+    # results and trace stores
+    'store_append', 'store_write', 'store_arrays', 'store_read', 'load_table', 'store_import', 'store_export',
+    'TRACE_METRICS', 'trace_stamps', 'trace_changed', 'trace_append', 'build_traces', 'trace_arrays', 'trace_sessions', 'trace_rows', 'trace_scores',
+]
+
+class LazyModule:
+    '''
+        Module imported on its first use. pandas and numpy take most of the import time of
+        dhcpy, lazy imports keep the path and session helpers (and the CLI, see dhcpy_cli.py)
+        fast to start.
+    '''
+    def __init__(self, name):
+        self.__dict__['name'] = name
+        self.__dict__['module'] = None
+
+    def __getattr__(self, attribute):
+        if self.module is None:
+            self.__dict__['module'] = importlib.import_module(self.name)
+        return getattr(self.module, attribute)
+
+pd = LazyModule('pandas')
+np = LazyModule('numpy')
+
 def get_host():
     hostname = gethostname()
     if hostname != "viper":
@@ -47,7 +104,10 @@ def init_host():
 def dhcp_root():
     '''
      string: Returns the full path to the root directory for the dhcp dataset.
+     The DHCP_ROOT environment variable overrides it (e.g. for a synthetic dataset, see dhcpy_bench).
     '''
+    if os.environ.get('DHCP_ROOT'):
+        return os.environ['DHCP_ROOT']
     if gethostname() == 'viper':
         return "/home/dderman/baby_ICA"
     else:
@@ -60,6 +120,164 @@ def is_number(s):
     except ValueError:
         return False
 
+#########################################################################
+# Profiling
+#
+# Stage timers (timed), counters (count) and per-session records
+# (profile_session) written as json lines to a trace file. Everything is a
+# no-op until enable_profiling is called. Records are per thread, so the
+# crop thread pool and forked scoring workers each keep their own.
+
+profiling = {'enabled': False, 'trace_file': None, 'records': list()}
+profile_local = threading.local()
+
+def enable_profiling(trace_file=None):
+    '''
+        Turns on the stage timers and counters. Session records are appended as json lines to
+        trace_file, or kept in profiling['records'] if None. Forked workers inherit the setting.
+    '''
+    profiling['enabled'] = True
+    profiling['trace_file'] = trace_file
+
+def disable_profiling():
+    profiling['enabled'] = False
+
+def current_record():
+    '''
+        Profiling record of the session running in this thread, or of the whole run.
+    '''
+    record = getattr(profile_local, 'record', None)
+    if record is None:
+        record = profiling.setdefault('run', {'stages': {}, 'counters': {}})
+    return record
+
+def count(name, amount=1):
+    '''
+        Adds amount to a counter (bytes_read, bytes_written, ...) of the current session.
+    '''
+    if profiling['enabled']:
+        counters = current_record()['counters']
+        counters[name] = counters.get(name, 0) + amount
+
+@contextmanager
+def timed(stage, subprocess_call=False):
+    '''
+        Context manager timing a stage of the current session (wall seconds, summed over calls).
+        subprocess_call also adds the time to the subprocess_s counter.
+    '''
+    if not profiling['enabled']:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        stages = current_record()['stages']
+        stages[stage] = stages.get(stage, 0.0) + elapsed
+        if subprocess_call:
+            count('subprocess_s', elapsed)
+
+def profiled(stage):
+    '''
+        Decorator version of timed.
+    '''
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not profiling['enabled']:
+                return function(*args, **kwargs)
+            with timed(stage):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def reset_peak_rss():
+    '''
+        Resets the peak resident memory of this process (Linux: /proc/self/clear_refs), so that
+        peak_rss_mb reports the peak since then. returns False if it cannot be reset.
+    '''
+    try:
+        with open('/proc/self/clear_refs', 'w') as fh:
+            fh.write('5')
+        return True
+    except OSError:
+        return False
+
+def peak_rss_mb():
+    '''
+        Peak resident memory of this process, in MB: since the last reset_peak_rss on Linux
+        (VmHWM), over the life of the process elsewhere (ru_maxrss).
+    '''
+    try:
+        with open('/proc/self/status') as fh:
+            for line in fh:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+@contextmanager
+def profile_session(subid, sesid, phase):
+    '''
+        Collects the stage timers and counters of one session's phase (e.g. score, crop) and writes
+        them as one json line, with the wall time and the peak RSS of the worker process during the
+        phase (peak_rss_mb, reset at its start). The peak is per process: where it cannot be reset,
+        or sessions overlap in threads of one process (e.g. the crop pool), it includes theirs.
+    '''
+    if not profiling['enabled']:
+        yield None
+        return
+    record = {'participant_id': subid, 'session_id': str(sesid), 'phase': phase, 'pid': os.getpid(),
+              'start': time.time(), 'stages': {}, 'counters': {}}
+    profile_local.record = record
+    reset_peak_rss()
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        profile_local.record = None
+        record['wall'] = time.perf_counter() - start
+        record['peak_rss_mb'] = peak_rss_mb()
+        if profiling['trace_file']:
+            with open(profiling['trace_file'], 'a') as fh:
+                fh.write(json.dumps(record) + '\n')
+        else:
+            profiling['records'].append(record)
+
+def profile_summary(trace=None):
+    '''
+        End-of-run summary of the session records: for each phase and metric (wall, peak_rss_mb,
+        stage times and counters), the amount of sessions, total, mean, median, 95th percentile and max.
+        input:
+            trace: json lines trace file, or list of records. profiling['records'] by default.
+    '''
+    if trace is None:
+        trace = profiling['records']
+    if isinstance(trace, str):
+        with open(trace) as fh:
+            trace = [json.loads(line) for line in fh if line.strip()]
+    values = dict()
+    for record in trace:
+        metrics = {'wall': record['wall'], 'peak_rss_mb': record['peak_rss_mb']}
+        metrics.update(('time:' + stage, seconds) for stage, seconds in record['stages'].items())
+        metrics.update(record['counters'])
+        for metric, value in metrics.items():
+            values.setdefault((record['phase'], metric), list()).append(value)
+    rows = list()
+    for (phase, metric), metric_values in sorted(values.items()):
+        metric_values = np.asarray(metric_values, dtype=float)
+        rows.append({'phase': phase, 'metric': metric, 'sessions': len(metric_values),
+                     'total': metric_values.sum(), 'mean': metric_values.mean(),
+                     'p50': np.percentile(metric_values, 50), 'p95': np.percentile(metric_values, 95),
+                     'max': metric_values.max()})
+    return pd.DataFrame(rows, columns=['phase', 'metric', 'sessions', 'total', 'mean', 'p50', 'p95', 'max'])
+
+#########################################################################
+# Tables, censoring and images
+
 def success_report(dataframe, output_field, output, subid, sesid):
     '''
         To the dataframe, adds a column stating the output state of the algorithm.
@@ -91,89 +309,1334 @@ def is_multisession(dataframe, subid):
 
 def filter_by(input_dataframe, expression) -> object:
     '''
-        input: pandas dataframe. DEPRECATED FROM LAST VERSION NO LONGER A PKLFILE
-        returns a filtered pandas of the csvfile list with the n lowest (highest) after sorted by field.
-        expression: must be a statement of the form field >,<,= value.
+        input: pandas dataframe.
+        returns the rows of the dataframe matching expression, see query.
+        expression: e.g. "field > value", or compound expressions such as
+        "term, singleton, mean_fd < 0.3, dvars_outliers < 200".
+        raises ValueError for malformed expressions or unknown fields.
     '''
+    return query(input_dataframe, expression)
 
-    # parse to check if spaces were added
-    import re
+# Shorthands usable as clauses of query expressions.
+QUERY_ALIASES = {'term': 'birth_age >= 37',
+                 'preterm': 'birth_age < 37',
+                 'singleton': "singleton == 'single'"}
 
-    if " " not in expression:
-        '''
-        split = re.split('>|<|=|>=|<=|==', expression)
-        field = split[0]
-        value = split[1]
-        symbol = expression[len(field) + 1:len(field) + 2]
-        '''
-        print("ERROR: Expression must contain spaces.")
-        return 1
-    else:
-        split = expression.split()
-        field = split[0]
-        symbol = split[1]
-        value = split[2]
-        if is_number(value): value = float(value)
-
-    # load pandas dataframe
-    df = input_dataframe
-
-    # Make sure field is in the header
-
-    if field not in df.columns:
-        print("ERROR: Unknown field " + field + ".")
-        print(df.columns)
-
-    # get type of field.
-
-    if type(df[field]) == str:
-        print("WARNING: Field " + field + " was str.")
-        df[field] = df[field].to_numeric()
-
-    if symbol == '>':
-        return df[df[field] > value]
-    elif symbol == '<':
-        return df[df[field] < value]
-    if symbol == '>=':
-        return df[df[field] >= value]
-    if symbol == '<=':
-        return df[df[field] <= value]
-    if symbol == '=':
-        return df[df[field] == value]
-    if symbol == '==':
-        return df[df[field] == value]
+QUERY_TOKEN = re.compile(r"""\s*(?:(-?\d+\.?\d*(?:[eE][-+]?\d+)?)|('[^']*'|"[^"]*")|(<=|>=|==|!=|<|>|=)|([(),])|([A-Za-z_][\w.]*))""")
+
+def tokenize_query(expression):
+    '''
+        Splits a query expression into [kind, text] tokens: number, string, op, punct or name.
+    '''
+    tokens = list()
+    position = 0
+    expression = expression.strip()
+    while position < len(expression):
+        match = QUERY_TOKEN.match(expression, position)
+        if match is None or match.end() == position:
+            raise ValueError("Cannot parse query at: " + expression[position:])
+        kind = ['number', 'string', 'op', 'punct', 'name'][match.lastindex - 1]
+        tokens.append([kind, match.group(match.lastindex)])
+        position = match.end()
+        while position < len(expression) and expression[position].isspace():
+            position = position + 1
+    return tokens
+
+def compare_column(field, symbol, value):
+    '''
+        Vectorized predicate for one "field symbol value" clause.
+        Numbers compare numerically (string columns are converted), strings compare
+        case-insensitively.
+    '''
+    def predicate(df):
+        if field not in df.columns:
+            raise ValueError("Unknown field " + field + ". Fields: " + ", ".join(df.columns))
+        column = df[field]
+        if isinstance(value, str):
+            column = column.astype(str).str.lower()
+            target = value.lower()
+        else:
+            column = pd.to_numeric(column, errors='coerce')
+            target = value
+        if symbol == '<':
+            result = column < target
+        elif symbol == '<=':
+            result = column <= target
+        elif symbol == '>':
+            result = column > target
+        elif symbol == '>=':
+            result = column >= target
+        elif symbol in ('=', '=='):
+            result = column == target
+        else:
+            result = column != target
+        return np.asarray(result, dtype=bool)
+    return predicate
+
+def compile_query(expression, aliases=None):
+    '''
+        Parses a cohort query once into a vectorized predicate.
+        Grammar: clauses separated by commas are and-ed; a clause is a comparison
+        "field op value" (op: < <= > >= = == !=), an alias (QUERY_ALIASES, e.g. term, singleton),
+        a boolean column, "not" clause, clauses joined by "and"/"or", or a parenthesized query.
+        Values are numbers, or strings (quoted, or bare words).
+        output:
+            predicate(dataframe) -> boolean numpy mask of the matching rows.
+    '''
+    if aliases is None:
+        aliases = QUERY_ALIASES
+    tokens = tokenize_query(expression)
+    position = [0]
+
+    def peek():
+        return tokens[position[0]] if position[0] < len(tokens) else [None, None]
+
+    def take(expected=None):
+        token = peek()
+        if token[0] is None or (expected is not None and token[1] != expected):
+            raise ValueError("Expected " + str(expected or "a clause") + " in query: " + expression)
+        position[0] = position[0] + 1
+        return token
+
+    def parse_query():
+        clauses = [parse_or()]
+        while peek()[1] == ',':
+            take(',')
+            clauses.append(parse_or())
+        return combine(clauses, np.logical_and)
+
+    def parse_or():
+        clauses = [parse_and()]
+        while peek()[1] == 'or':
+            take('or')
+            clauses.append(parse_and())
+        return combine(clauses, np.logical_or)
+
+    def parse_and():
+        clauses = [parse_not()]
+        while peek()[1] == 'and':
+            take('and')
+            clauses.append(parse_not())
+        return combine(clauses, np.logical_and)
+
+    def parse_not():
+        if peek()[1] == 'not':
+            take('not')
+            clause = parse_not()
+            return lambda df: np.logical_not(clause(df))
+        return parse_atom()
+
+    def parse_atom():
+        kind, text = take()
+        if text == '(':
+            clause = parse_query()
+            take(')')
+            return clause
+        if kind != 'name':
+            raise ValueError("Expected a field name, got " + text + " in query: " + expression)
+        if peek()[0] == 'op':
+            symbol = take()[1]
+            value_kind, value = take()
+            if value_kind == 'number':
+                value = float(value)
+            elif value_kind == 'string':
+                value = value[1:-1]
+            elif value_kind != 'name':
+                raise ValueError("Expected a value after " + text + " " + symbol + " in query: " + expression)
+            return compare_column(text, symbol, value)
+        if text in aliases:
+            return compile_query(aliases[text], aliases)
+        # bare boolean column
+        def column_predicate(df):
+            if text not in df.columns:
+                raise ValueError("Unknown field or alias " + text + ". Fields: " + ", ".join(df.columns))
+            return np.asarray(df[text], dtype=bool)
+        return column_predicate
+
+    def combine(clauses, operation):
+        if len(clauses) == 1:
+            return clauses[0]
+        return lambda df: operation.reduce([clause(df) for clause in clauses])
+
+    predicate = parse_query()
+    if position[0] != len(tokens):
+        raise ValueError("Unexpected " + tokens[position[0]][1] + " in query: " + expression)
+    return predicate
+
+# compiled_queries[expression]: predicates already parsed by query.
+compiled_queries = dict()
+
+def join_qc(table, qc, on=('participant_id', 'session_id')):
+    '''
+        Adds the columns of a QC output table (e.g. rel2_dvars) to a participants table,
+        matching rows by participant and session. Keys are matched as strings, so int and str
+        session ids join. Rows without QC are dropped.
+    '''
+    keys = list(on)
+    temp_keys = ['__' + key for key in keys]
+    extra = [column for column in qc.columns if column not in table.columns]
+    left = table.assign(**{temp: table[key].astype(str) for temp, key in zip(temp_keys, keys)})
+    right = qc[extra].assign(**{temp: qc[key].astype(str) for temp, key in zip(temp_keys, keys)})
+    return left.merge(right, on=temp_keys, how='inner').drop(columns=temp_keys)
+
+def query(table, expression, qc=None, on=('participant_id', 'session_id')):
+    '''
+        Selects the rows of table matching a compound expression in one pass with boolean masks,
+        e.g. query(participants, "term, singleton, mean_fd < 0.3, dvars_outliers < 200", qc=rel2_dvars).
+        input:
+            table: pandas dataframe.
+            expression: str or compiled predicate, see compile_query.
+            qc: optional QC dataframe joined first by participant and session, see join_qc.
+        output:
+            pandas dataframe with the matching rows.
+    '''
+    if qc is not None:
+        table = join_qc(table, qc, on)
+    if isinstance(expression, str):
+        if expression not in compiled_queries:
+            compiled_queries[expression] = compile_query(expression)
+        expression = compiled_queries[expression]
+    return table[expression(table)]
+
+def dvars_threshold(traces, iqr_factor=1.5):
+    '''
+        Subject-specific DVARS threshold: iqr_factor times the IQR over the 75th percentile.
+        input:
+            traces: array - one DVARS trace (frames) or a subjects x frames array, NaN padded
+                if lengths differ.
+            iqr_factor: float - IQR multiplier, 1.5 as in Eyre et al., 2022.
+        output:
+            threshold: float, or one threshold per subject for 2-D input.
+    '''
+    traces = np.asarray(traces, dtype=float)
+    percentile = np.nanpercentile if np.isnan(traces).any() else np.percentile
+    p25, p75 = percentile(traces, [25, 75], axis=-1)
+    return iqr_factor * (p75 - p25) + p75
+
+def prefix_counts(outliers, dtype='int64'):
+    '''
+        Prefix sums of outlier frames (or of any per-frame values, with a float dtype)
+        with a leading zero, subjects x (frames + 1).
+    '''
+    outliers = np.atleast_2d(outliers)
+    cs = np.zeros((outliers.shape[0], outliers.shape[1] + 1), dtype=dtype)
+    np.cumsum(outliers, axis=1, out=cs[:, 1:])
+    return cs
+
+def window_counts(outliers, keep_vols=1600, BOLD_length=2299, prefix=None):
+    '''
+        Counts the outlier frames of every window of keep_vols frames using prefix sums.
+        input:
+            outliers: bool array - frames (or subjects x frames) flagged as outliers.
+            keep_vols: int - window length.
+            BOLD_length: int - run length, window offsets go from 0 to BOLD_length - keep_vols - 1.
+            prefix: prefix_counts(outliers), if already computed (outliers is then ignored).
+        output:
+            counts: int array - (subjects x offsets) outlier counts.
+    '''
+    if prefix is None:
+        prefix = prefix_counts(outliers)
+    n_frames = prefix.shape[1] - 1
+    # counts[i] = cs[i + keep_vols] - cs[i], windows are cut at the end of shorter runs.
+    starts = np.minimum(np.arange(max(BOLD_length - keep_vols, 0)), n_frames)
+    ends = np.minimum(starts + keep_vols, n_frames)
+    return prefix[:, ends] - prefix[:, starts]
+
+def min_window(counts, keep_vols=1600):
+    '''
+        Least outlier count and first offset reaching it, per row of window_counts.
+    '''
+    if counts.shape[1] == 0:
+        # no window fits, keep the legacy defaults.
+        return [np.full(counts.shape[0], keep_vols), np.zeros(counts.shape[0], dtype=int)]
+    min_idx = np.argmin(counts, axis=1)
+    return [counts[np.arange(counts.shape[0]), min_idx], min_idx]
+
+def best_window(outliers, keep_vols=1600, BOLD_length=2299):
+    '''
+        Finds the window of keep_vols frames with the least outlier frames.
+        input:
+            outliers: bool array - frames (or subjects x frames) flagged as outliers.
+        output:
+            [min_volsOver, min_idx]: amount of outliers and first index of the best window,
+            arrays with one value per subject for 2-D input.
+    '''
+    min_volsOver, min_idx = min_window(window_counts(outliers, keep_vols, BOLD_length), keep_vols)
+    if np.ndim(outliers) == 1:
+        return [int(min_volsOver[0]), int(min_idx[0])]
+    return [min_volsOver, min_idx]
+
+def dvars_scores(traces, keep_vols=1600, BOLD_length=2299, iqr_factor=1.5, threshold=None):
+    '''
+        Scores one DVARS trace, or a whole cohort as a subjects x frames array (NaN padded), in one call.
+        The first frame is left out of the threshold and mean, as in dvars().
+        threshold: fixed threshold (e.g. a cohort threshold, see cohort_thresholds), or one per subject,
+        instead of the subject-specific dvars_threshold.
+        output:
+            [min_volsOver, min_idx, mean_dvars]: scalars for a 1-D trace, arrays for 2-D input.
+    '''
+    traces = np.asarray(traces, dtype=float)
+    if threshold is None:
+        threshold = dvars_threshold(traces[..., 1:], iqr_factor)
+    threshold = np.asarray(threshold, dtype=float)
+    if traces.ndim == 2 and threshold.ndim == 0:
+        threshold = np.full(traces.shape[0], threshold)
+    mean_dvars = np.nanmean(traces[..., 1:], axis=-1)
+    outliers = traces > np.expand_dims(threshold, -1)
+    min_volsOver, min_idx = best_window(outliers, keep_vols, BOLD_length)
+    if traces.ndim == 1:
+        mean_dvars = float(mean_dvars)
+    return [min_volsOver, min_idx, mean_dvars]
+
+# criteria of joint_scores, in their default lexicographic order.
+WINDOW_CRITERIA = ('dvars_outliers', 'fd_outliers', 'fd_sum')
+
+def joint_scores(dvars_traces, fd_traces, keep_vols=1600, BOLD_length=2299, iqr_factor=1.5, fd_threshold=0.5,
+                 weights=None, threshold=None):
+    '''
+        Chooses the window of keep_vols frames on DVARS and framewise displacement together.
+        Every offset is scored on its DVARS outliers (as dvars_scores), FD outliers (FD over
+        fd_threshold) and FD sum, all from prefix sums in one pass, for one session or a
+        subjects x frames batch of each (NaN padded). Both traces are indexed from the same
+        offset, the start of the crop, as start_best_interval.
+        input:
+            weights: [dvars_outliers, fd_outliers, fd_sum] weights of a weighted sum of the
+                criteria. None orders windows lexicographically by WINDOW_CRITERIA instead, so
+                FD only breaks DVARS ties.
+            threshold: fixed DVARS threshold(s), see dvars_scores.
+        output:
+            [min_volsOver, fd_outliers, fd_sum, min_idx, mean_dvars] of the chosen window:
+            scalars for 1-D traces, arrays for 2-D input.
+    '''
+    dvars_traces = np.asarray(dvars_traces, dtype=float)
+    fd_traces = np.atleast_2d(np.asarray(fd_traces, dtype=float))
+    traces = np.atleast_2d(dvars_traces)
+    if threshold is None:
+        threshold = dvars_threshold(traces[:, 1:], iqr_factor)
+    threshold = np.broadcast_to(np.asarray(threshold, dtype=float), (traces.shape[0],))
+    mean_dvars = np.nanmean(traces[:, 1:], axis=-1)
+
+    # subjects x offsets, NaN frames count as neither outliers nor displacement.
+    dvars_counts = window_counts(traces > threshold[:, None], keep_vols, BOLD_length)
+    fd_counts = window_counts(fd_traces > fd_threshold, keep_vols, BOLD_length)
+    fd_sums = window_counts(None, keep_vols, BOLD_length, prefix_counts(np.nan_to_num(fd_traces), np.float64))
+    rows = np.arange(traces.shape[0])
+    if dvars_counts.shape[1] == 0:
+        # no window fits, keep the legacy defaults.
+        min_idx = np.zeros(traces.shape[0], dtype=int)
+        scores = [np.full(traces.shape[0], keep_vols), np.zeros(traces.shape[0], dtype=int), np.zeros(traces.shape[0])]
     else:
-        print("Error symbol.")
-        return 1
+        if weights is None:
+            # per row, the first offset of the lexicographically smallest criteria
+            offsets = np.broadcast_to(np.arange(dvars_counts.shape[1]), dvars_counts.shape)
+            order = np.lexsort((offsets.ravel(), fd_sums.ravel(), fd_counts.ravel(), dvars_counts.ravel(),
+                                np.repeat(rows, dvars_counts.shape[1])))
+            min_idx = order[rows * dvars_counts.shape[1]] % dvars_counts.shape[1]
+        else:
+            min_idx = np.argmin(weights[0] * dvars_counts + weights[1] * fd_counts + weights[2] * fd_sums, axis=1)
+        scores = [dvars_counts[rows, min_idx], fd_counts[rows, min_idx], fd_sums[rows, min_idx]]
+
+    if dvars_traces.ndim == 1:
+        return [int(scores[0][0]), int(scores[1][0]), float(scores[2][0]), int(min_idx[0]), float(mean_dvars[0])]
+    return scores + [min_idx, mean_dvars]
 
-def dvars(csvfile):
+def censoring_sweep(traces, iqr_factors=(1.5,), window_lengths=(1600,), BOLD_length=2299,
+                    max_outlier_fraction=0.1, subjects=None):
     '''
-		 csvfile of a single subject's dvars as input
-         returns the rating and location of subjects 1600 best volumes
-         returns -1 is the subject is to be discarded according to dvars.
+        Scores a cohort at every combination of IQR multiplier and window length, from one
+        subjects x frames array of DVARS traces (as scored by dvars_scores, NaN padded).
+        Percentiles are computed once per subject and prefix sums once per multiplier,
+        so each extra window length only costs a slice.
+        input:
+            iqr_factors: list of float - threshold multipliers of the IQR over P75.
+            window_lengths: list of int - retained window lengths (keep_vols).
+            max_outlier_fraction: float - a subject is retained if its best window has at most
+                this fraction of outlier frames.
+            subjects: labels of the rows, e.g. participant ids. Row position by default.
+        output:
+            pandas dataframe, one row per subject and grid point, with columns subject, iqr_factor,
+            window_length, threshold, dvars_outliers, start_best_interval, retained.
+            See sweep_summary for the retained subjects per grid point.
+    '''
+    traces = np.atleast_2d(np.asarray(traces, dtype=float))
+    if subjects is None:
+        subjects = np.arange(traces.shape[0])
+    percentile = np.nanpercentile if np.isnan(traces).any() else np.percentile
+    p25, p75 = percentile(traces[:, 1:], [25, 75], axis=1)
+
+    tables = list()
+    for iqr_factor in iqr_factors:
+        threshold = iqr_factor * (p75 - p25) + p75
+        prefix = prefix_counts(traces > threshold[:, None])
+        for keep_vols in window_lengths:
+            min_volsOver, min_idx = min_window(window_counts(None, keep_vols, BOLD_length, prefix), keep_vols)
+            tables.append(pd.DataFrame({'subject': subjects,
+                                        'iqr_factor': iqr_factor,
+                                        'window_length': keep_vols,
+                                        'threshold': threshold,
+                                        'dvars_outliers': min_volsOver,
+                                        'start_best_interval': min_idx,
+                                        'retained': min_volsOver <= max_outlier_fraction * keep_vols}))
+    return pd.concat(tables, ignore_index=True)
+
+def sweep_summary(sweep):
+    '''
+        Retained subjects and median outliers per grid point of a censoring_sweep table.
+    '''
+    return sweep.groupby(['iqr_factor', 'window_length']).agg(
+        retained=('retained', 'sum'), median_outliers=('dvars_outliers', 'median')).reset_index()
+
+def pad_traces(traces, length=None):
+    '''
+        Stacks traces of unequal length into a subjects x frames array padded with NaN.
+    '''
+    if length is None:
+        length = max(len(trace) for trace in traces)
+    stacked = np.full((len(traces), length), np.nan)
+    for i, trace in enumerate(traces):
+        stacked[i, :min(len(trace), length)] = trace[:length]
+    return stacked
+
+def dvars(csvfile, keep_vols=1600, BOLD_length=2299, iqr_factor=1.5, threshold=None):
+    '''
+         dvars: calculates the interval of minimum amount of frames over the DVARS threshold as explained in Eyre et al., 2022.
+         Returns the amount of frames over the threshold, the index where the interval starts, and the mean dvars over the whole run.
+
+         Input: The previously generated csvfile of a single subject's dvars as input (see fsl_motion_outliers).
+         keep_vols and BOLD_length default to the dhcp 2nd release, you may need to change them.
+         threshold: cohort threshold mode, a fixed DVARS threshold (see cohort_thresholds) instead of the subject's.
+
+         returns the rating and location of subjects keep_vols best volumes
+         returns -1 if the csvfile cannot be found.
     '''
     if not os.path.exists(csvfile):
         print(csvfile)
         return -1
+    subject_dvars = read_trace(csvfile)
+    with timed('dvars'):
+        return dvars_scores(subject_dvars, keep_vols, BOLD_length, iqr_factor, threshold)
+
+class QuantileSketch:
+    '''
+        Mergeable streaming quantile sketch (KLL). Values are kept in compactors of growing
+        weight; a full compactor is sorted and every other value (random offset) moves up one
+        level with twice the weight. Memory is O(k log(n / k)) and the rank error about 1.7 / k
+        of n. Sketches of parallel workers merge into the sketch of all their values, and are
+        picklable. Without a seed, the offsets are seeded by the first values seen, so the same
+        inputs in the same order give the same sketch, and sketches of different traces are
+        independent.
+    '''
+    def __init__(self, k=400, seed=None):
+        self.k = k
+        self.n = 0
+        self.compactors = [np.zeros(0)]
+        self.rng = np.random.default_rng(seed) if seed is not None else None
+
+    def seed_from(self, values):
+        if self.rng is None:
+            self.rng = np.random.default_rng(zlib.crc32(np.ascontiguousarray(values).tobytes()))
+
+    def capacity(self, level):
+        return max(2, int(np.ceil(self.k * (2 / 3) ** (len(self.compactors) - 1 - level))))
+
+    def compress(self):
+        level = 0
+        while level < len(self.compactors):
+            if len(self.compactors[level]) > self.capacity(level):
+                if level + 1 == len(self.compactors):
+                    self.compactors.append(np.zeros(0))
+                values = np.sort(self.compactors[level])
+                # an odd value out stays at this level
+                keep = values[len(values) - len(values) % 2:]
+                promoted = values[self.rng.integers(2):len(values) - len(values) % 2:2]
+                self.compactors[level] = keep
+                self.compactors[level + 1] = np.concatenate([self.compactors[level + 1], promoted])
+            level = level + 1
+
+    def update(self, values):
+        values = np.asarray(values, dtype=float).ravel()
+        values = values[~np.isnan(values)]
+        self.seed_from(values)
+        self.n = self.n + len(values)
+        # in blocks, so that level 0 stays bounded for long inputs
+        for block in range(0, len(values), self.k):
+            self.compactors[0] = np.concatenate([self.compactors[0], values[block:block + self.k]])
+            self.compress()
+        return self
+
+    def merge(self, other):
+        self.seed_from(np.concatenate(other.compactors))
+        while len(self.compactors) < len(other.compactors):
+            self.compactors.append(np.zeros(0))
+        for level, values in enumerate(other.compactors):
+            self.compactors[level] = np.concatenate([self.compactors[level], values])
+        self.n = self.n + other.n
+        self.compress()
+        return self
+
+    def quantile(self, q):
+        '''
+            Approximate q quantiles (q in [0, 1], scalar or list), NaN if empty.
+        '''
+        values = np.concatenate(self.compactors)
+        if len(values) == 0:
+            return np.full(np.shape(q), np.nan) if np.ndim(q) else np.nan
+        weights = np.concatenate([np.full(len(values), 2.0 ** level) for level, values in enumerate(self.compactors)])
+        order = np.argsort(values, kind='stable')
+        ranks = np.cumsum(weights[order])
+        position = np.searchsorted(ranks, np.asarray(q) * ranks[-1], side='left')
+        return values[order][np.minimum(position, len(values) - 1)]
+
+def sketch_threshold(sketch, iqr_factor=1.5):
+    '''
+        P25, P75, IQR and DVARS threshold (iqr_factor times the IQR over P75) of a sketch.
+    '''
+    p25, p75 = sketch.quantile([0.25, 0.75])
+    return {'p25': p25, 'p75': p75, 'iqr': p75 - p25, 'threshold': iqr_factor * (p75 - p25) + p75}
+
+def age_strata(ages, edges=(37, 40, 42)):
+    '''
+        Labels of age strata (weeks) cut at edges, e.g. "<37", "[37, 40)", ">=42".
+    '''
+    ages = np.asarray(ages, dtype=float)
+    names = [format(edge, 'g') for edge in edges]
+    labels = ['<' + names[0]] + ['[' + low + ', ' + high + ')' for low, high in zip(names[:-1], names[1:])] + \
+             ['>=' + names[-1]]
+    return [labels[i] for i in np.searchsorted(edges, ages, side='right')]
+
+def cohort_thresholds(traces, strata=None, iqr_factor=1.5, k=400):
+    '''
+        Per-subject, cohort and per-stratum DVARS thresholds in one pass over the traces.
+        Subjects get exact percentiles, as dvars_threshold, the cohort and strata get
+        QuantileSketch estimates, so memory does not grow with the cohort. The first frame
+        of each trace is left out, as in dvars().
+        input:
+            traces: iterable of DVARS traces (e.g. a generator reading one file at a time), or of
+                QuantileSketch of each trace already computed by workers (then with NaN subject rows).
+            strata: stratum label of each trace (e.g. age_strata of scan_age), None for cohort only.
+        output:
+            [subjects, groups]: dataframes with p25, p75, iqr and threshold columns, one row per
+            trace, and one row for the cohort ("cohort") and each stratum (with its sessions and frames).
+    '''
+    cohort = QuantileSketch(k)
+    sketches = OrderedDict()
+    sessions = dict()
+    subjects = list()
+    for i, trace in enumerate(traces):
+        if isinstance(trace, QuantileSketch):
+            sketch = trace
+            subjects.append({'p25': np.nan, 'p75': np.nan, 'iqr': np.nan, 'threshold': np.nan})
+        else:
+            trace = np.asarray(trace, dtype=float)[1:]
+            sketch = QuantileSketch(k).update(trace)
+            p25, p75 = np.nanpercentile(trace, [25, 75])
+            subjects.append({'p25': p25, 'p75': p75, 'iqr': p75 - p25, 'threshold': iqr_factor * (p75 - p25) + p75})
+        cohort.merge(sketch)
+        if strata is not None:
+            if strata[i] not in sketches:
+                sketches[strata[i]] = QuantileSketch(k)
+                sessions[strata[i]] = 0
+            sketches[strata[i]].merge(sketch)
+            sessions[strata[i]] = sessions[strata[i]] + 1
+
+    groups = [dict(stratum='cohort', sessions=len(subjects), frames=cohort.n, **sketch_threshold(cohort, iqr_factor))]
+    for stratum, sketch in sketches.items():
+        groups.append(dict(stratum=stratum, sessions=sessions[stratum], frames=sketch.n, **sketch_threshold(sketch, iqr_factor)))
+    return [pd.DataFrame(subjects, columns=['p25', 'p75', 'iqr', 'threshold']), pd.DataFrame(groups)]
+
+class BlockGzipWriter:
+    '''
+        Write-only gzip stream compressed in parallel: the data is cut in blocks of block_size
+        bytes, each compressed by a thread pool into its own gzip member and written in order.
+        Concatenated members are a valid gzip file, readable as an ordinary .nii.gz (nibabel,
+        FSL, zcat). zlib releases the GIL, so the threads compress at the same time.
+        tell() is the uncompressed position, as for gzip.open.
+    '''
+    def __init__(self, fname, threads=4, compresslevel=1, block_size=2 ** 22):
+        from concurrent.futures import ThreadPoolExecutor
+        self.fh = open(fname, "wb")
+        self.threads = threads
+        self.compresslevel = compresslevel
+        self.block_size = block_size
+        self.pool = ThreadPoolExecutor(threads)
+        self.pending = list()
+        self.buffer = bytearray()
+        self.position = 0
+
+    def compress(self, block):
+        return gzip.compress(block, self.compresslevel, mtime=0)
+
+    def submit(self, block):
+        self.pending.append(self.pool.submit(self.compress, bytes(block)))
+        # at most 2 blocks per thread in flight
+        while len(self.pending) > 2 * self.threads:
+            self.fh.write(self.pending.pop(0).result())
+
+    def write(self, data):
+        self.buffer.extend(data)
+        self.position = self.position + len(data)
+        while len(self.buffer) >= self.block_size:
+            self.submit(self.buffer[:self.block_size])
+            del self.buffer[:self.block_size]
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        if self.fh.closed:
+            return
+        try:
+            if self.buffer or self.position == 0:
+                self.submit(self.buffer)
+            for job in self.pending:
+                self.fh.write(job.result())
+        finally:
+            self.pool.shutdown()
+            self.fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def open_nifti(fname, mode="rb", compresslevel=1, threads=1):
+    '''
+        Opens a nifti file as a binary stream, gzipped if the name ends in .gz.
+        compresslevel only applies to writing, 1 is the nibabel default.
+        threads > 1 writes block gzip in parallel (BlockGzipWriter).
+    '''
+    if fname.endswith(".gz"):
+        if "w" in mode and threads > 1:
+            return BlockGzipWriter(fname, threads, compresslevel)
+        return gzip.open(fname, mode, compresslevel=compresslevel)
+    return open(fname, mode)
+
+def crop_nifti(bold, fcropped, start, period_length=1600, chunk_vols=64, compresslevel=1, threads=1):
+    '''
+        Crops a 4-D nifti in-process, keeping the frames in [start, start + period_length).
+        Only the header is parsed (nibabel), the frames are copied as raw bytes in chunks of
+        chunk_vols volumes, so the data type, scaling and the rest of the header are preserved
+        and memory stays bounded. Gzipped input is streamed, plain .nii input is seeked.
+        input:
+            bold: str - path of the 4-D input image.
+            fcropped: str - path of the output image, gzipped if it ends in .gz. A plain .nii
+                output can be memory-mapped by readers.
+            threads: int - threads compressing a .gz output (block gzip, see BlockGzipWriter).
+        output:
+            fcropped
+    '''
+    import nibabel as nib
+
+    img = nib.load(bold)
+    shape = img.shape
+    if len(shape) != 4 or start < 0 or start + period_length > shape[3]:
+        raise ValueError("Cannot crop frames " + str(start) + "-" + str(start + period_length) +
+                         " from " + bold + " of shape " + str(shape))
+    header = img.header.copy()
+    # nibabel moves the scaling to the data proxy, put it back with the raw data.
+    header.set_slope_inter(img.dataobj.slope, img.dataobj.inter)
+    vol_bytes = int(np.prod(shape[:3])) * header.get_data_dtype().itemsize
+    offset = int(img.dataobj.offset)
+    header.set_data_shape(shape[:3] + (period_length,))
+
+    with open_nifti(bold, "rb") as fin, open_nifti(fcropped, "wb", compresslevel, threads) as fout:
+        header.write_to(fout)
+        # zero padding between header (and extensions) and data
+        fout.write(b"\x00" * (int(header["vox_offset"]) - fout.tell()))
+        with timed('crop_seek'):
+            fin.seek(offset + start * vol_bytes)
+        remaining = period_length * vol_bytes
+        while remaining > 0:
+            with timed('crop_read'):
+                data = fin.read(min(chunk_vols * vol_bytes, remaining))
+            if not data:
+                raise IOError("Unexpected end of file in " + bold)
+            with timed('crop_write'):
+                fout.write(data)
+            count('bytes_read', len(data))
+            count('bytes_written', len(data))
+            remaining = remaining - len(data)
+    return fcropped
+
+def crop_fsl(bold, fcropped, start, period_length=1600):
+    '''
+        Crops a 4-D nifti with fslsplit and fslmerge in a temporary directory.
+        Fallback for crop_nifti, FSL must be on the path.
+    '''
+    # temporal directory for splitting operation, unique per call.
+    dir_split = tempfile.mkdtemp() + '/'
+    # name root of splited volumes
+    fsplit = dir_split + 'vol_'
+    try:
+        print("Starting splitting at " + dir_split)
+        # FSLSPLIT
+        with timed('fslsplit', subprocess_call=True):
+            subprocess.run(['fslsplit', bold, fsplit], check=True)
+
+        # fslmerge -t output_fname [splitted volumes], zero padded names
+        command_list = ["fslmerge", "-t", fcropped]
+        command_list.extend(fsplit + str(n).zfill(4) + '.nii.gz' for n in range(start, start + period_length))
+        with timed('fslmerge', subprocess_call=True):
+            process = subprocess.Popen(command_list, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            stdout, stderr = process.communicate()
+        print(stdout)
+        print(stderr)
+    finally:
+        # When finished, delete temp files.
+        rmtree(dir_split, ignore_errors=True)
+    return fcropped
+
+CROP_FORMATS = {"gz": ".nii.gz", "bgz": ".nii.gz", "nii": ".nii"}
+
+def cropped_path(subid, sesid, output_format=None):
+    '''
+        Canonical path of the cropped BOLD image of a session. "gz" and "bgz" are both .nii.gz,
+        "nii" is uncompressed (memory-mappable). If output_format is None, the existing file,
+        uncompressed first, or the .nii.gz path.
+    '''
+    froot = dhcp_root() + "/dhcp_fmri_cropped/" + subid + "/" + subid + "_ses-" + sesid + "_task-rest_desc-cropped_bold"
+    if output_format is None:
+        return froot + ".nii" if os.path.exists(froot + ".nii") else froot + ".nii.gz"
+    return froot + CROP_FORMATS[output_format]
+
+def crop(subid, sesid, start, period_length=1600, method="native", output_format="gz", gzip_threads=4, overwrite=False):
+    '''
+        crop: crops BOLD timeseries from the DHCP subject subid session sesid from index start and for period_length.
+        Saves in canonical DHCP 2nd release paths (see cropped_path), skips sessions already cropped.
+        The image is written to a partial file and renamed when complete, so an interrupted crop is
+        never taken as done; partial files left by killed runs are removed. overwrite crops again
+        sessions already cropped, e.g. unfinished in a journal (see journal_done).
+        method: "native" crops in-process (crop_nifti), "fsl" uses fslsplit/fslmerge (crop_fsl).
+        The native method falls back to FSL if nibabel is not installed.
+        output_format: "gz" (gzip), "bgz" (block gzip compressed by gzip_threads threads, also a valid
+        .nii.gz) or "nii" (uncompressed, memory-mappable intermediate). The fsl method only writes "gz".
+        returns the path of the cropped image.
+    '''
+    if output_format not in CROP_FORMATS:
+        raise ValueError("Unknown crop output format " + output_format)
+    # original preprocessed BOLD nifti.
+    bold = dhcp_root() + "/dhcp_fmri_pipeline" + '/sub-' + subid + "/ses-" + sesid + '/func/sub-' + subid + '_ses-' + sesid + '_task-rest_desc-preproc_bold.nii.gz'
+    # make output canonical directory
+    dir_cropped = dhcp_root() + "/dhcp_fmri_cropped/" + subid
+    os.makedirs(dir_cropped, exist_ok=True)
+    # ouput filename
+    fcropped = cropped_path(subid, sesid, output_format)
+
+    froot = fcropped[:-len(CROP_FORMATS[output_format])]
+    for stale in os.listdir(dir_cropped):
+        if (dir_cropped + "/" + stale).startswith(froot + ".partial-"):
+            os.remove(dir_cropped + "/" + stale)
+
+    # If not previously cropped
+    if overwrite or not os.path.exists(fcropped):
+        print("Scrubbing " + subid)
+        if method == "native":
+            try:
+                import nibabel
+            except ImportError:
+                print("Warning: nibabel not found, cropping with FSL.")
+                method = "fsl"
+        partial = froot + ".partial-" + str(os.getpid()) + "-" + str(threading.get_ident()) + CROP_FORMATS[output_format]
+        try:
+            if method == "native":
+                crop_nifti(bold, partial, start, period_length, threads=gzip_threads if output_format == "bgz" else 1)
+            elif method == "fsl":
+                if output_format == "nii":
+                    raise ValueError("The fsl crop method only writes .nii.gz")
+                crop_fsl(bold, partial, start, period_length)
+            else:
+                raise ValueError("Unknown crop method " + method)
+            os.replace(partial, fcropped)
+        finally:
+            if os.path.exists(partial):
+                os.remove(partial)
+    return fcropped
+
+def bold_chunks(bold, chunk_vols=64):
+    '''
+        Streams a 4-D nifti once, in file order, in chunks of chunk_vols volumes.
+        Only the header is parsed with nibabel, so memory stays bounded by the chunk size.
+        output:
+            [img, chunks]: the nibabel image (for its header and affine) and a generator of
+            voxels x volumes float64 arrays, scaled, with voxels in file (Fortran) order.
+    '''
+    import nibabel as nib
+
+    img = nib.load(bold)
+    shape = img.shape
+    dtype = img.header.get_data_dtype()
+    n_vox = int(np.prod(shape[:3]))
+    n_frames = shape[3] if len(shape) > 3 else 1
+    slope, inter = img.dataobj.slope, img.dataobj.inter
+
+    def chunks():
+        with open_nifti(bold, "rb") as fin:
+            fin.seek(int(img.dataobj.offset))
+            frame = 0
+            while frame < n_frames:
+                k = min(chunk_vols, n_frames - frame)
+                with timed('bold_read'):
+                    raw = fin.read(k * n_vox * dtype.itemsize)
+                if len(raw) < k * n_vox * dtype.itemsize:
+                    raise IOError("Unexpected end of file in " + bold)
+                count('bytes_read', len(raw))
+                chunk = np.frombuffer(raw, dtype=dtype).reshape((n_vox, k), order="F")
+                yield chunk.astype(np.float64) * slope + inter
+                frame = frame + k
+
+    return [img, chunks()]
+
+@profiled('bold_dvars')
+def bold_dvars(bold, mask=None, chunk_vols=64, csvfile=None):
+    '''
+        DVARS of a 4-D BOLD image computed in-process, as in fsl_motion_outliers --dvars: the RMS
+        intensity difference of each volume to the previous one within a brain mask, scaled to a
+        brain median of 1000. The first frame is 0.
+        The image is read once, in chunks of chunk_vols volumes (see bold_chunks).
+        input:
+            bold: str - path of the 4-D image, e.g. _desc-preproc_bold.nii.gz.
+            mask: str or bool array - brain mask. If None, voxels of the first volume over 10% of
+                its 98th percentile are used (the FSL brain threshold).
+            csvfile: str - if set, also writes the DVARS in the format of fsl_motion_outliers,
+                one value per line, as read by read_trace.
+        output:
+            dvars: float array, one value per frame.
+    '''
+    import nibabel as nib
+
+    img, chunks = bold_chunks(bold, chunk_vols)
+    n_frames = img.shape[3] if len(img.shape) > 3 else 1
+    if isinstance(mask, str):
+        mask = np.asanyarray(nib.load(mask).dataobj) > 0
+    if mask is not None:
+        mask = np.asarray(mask, dtype=bool).reshape(-1, order="F")
+
+    dvars_out = np.zeros(n_frames)
+    mean_sum = None
+    previous = None
+    frame = 0
+    for chunk in chunks:
+        k = chunk.shape[1]
+        if mask is None:
+            mask = chunk[:, 0] > 0.1 * np.percentile(chunk[:, 0], 98)
+        chunk = chunk[mask]
+        mean_sum = chunk.sum(axis=1) + (0 if mean_sum is None else mean_sum)
+        if previous is None:
+            diffs = np.diff(chunk, axis=1)
+            dvars_out[frame + 1:frame + k] = np.sqrt(np.mean(diffs ** 2, axis=0))
+        else:
+            diffs = np.diff(np.concatenate([previous, chunk], axis=1), axis=1)
+            dvars_out[frame:frame + k] = np.sqrt(np.mean(diffs ** 2, axis=0))
+        previous = chunk[:, -1:]
+        frame = frame + k
+
+    # normalize to a brain median of 1000, as fsl_motion_outliers does.
+    brain_median = np.median(mean_sum / n_frames)
+    if brain_median != 0:
+        dvars_out = dvars_out * 1000 / brain_median
+
+    if csvfile:
+        np.savetxt(csvfile, dvars_out, fmt="%.6f")
+    return dvars_out
+
+@profiled('bold_image_stats')
+def bold_image_stats(bold, chunk_vols=64, maps_prefix=None):
+    '''
+        Mean, sd, min and max over all the voxels and frames of a 4-D image, as fslstats -m -s -R,
+        in one streaming pass (see bold_chunks). Means and variances of the chunks are merged
+        with the Welford/Chan update, so they stay accurate over long runs.
+        input:
+            bold: str - path of the 4-D image.
+            maps_prefix: str - if set, also writes the voxelwise temporal mean, sd and tSNR
+                maps to maps_prefix + '_mean.nii.gz', '_sd.nii.gz' and '_tsnr.nii.gz'.
+        output:
+            [mean, sd, min, max]: floats, sd with n - 1 degrees of freedom.
+    '''
+    img, chunks = bold_chunks(bold, chunk_vols)
+    n = 0
+    mean = m2 = 0.0
+    vmin, vmax = np.inf, -np.inf
+    # voxelwise running moments over time
+    n_t = 0
+    vox_mean = vox_m2 = 0.0
+    for chunk in chunks:
+        k = chunk.size
+        chunk_mean = chunk.mean()
+        delta = chunk_mean - mean
+        m2 = m2 + ((chunk - chunk_mean) ** 2).sum() + delta ** 2 * n * k / (n + k)
+        mean = mean + delta * k / (n + k)
+        n = n + k
+        vmin = min(vmin, chunk.min())
+        vmax = max(vmax, chunk.max())
+        if maps_prefix:
+            k_t = chunk.shape[1]
+            chunk_vox_mean = chunk.mean(axis=1)
+            delta = chunk_vox_mean - vox_mean
+            vox_m2 = vox_m2 + ((chunk - chunk_vox_mean[:, None]) ** 2).sum(axis=1) + delta ** 2 * n_t * k_t / (n_t + k_t)
+            vox_mean = vox_mean + delta * k_t / (n_t + k_t)
+            n_t = n_t + k_t
+
+    if maps_prefix:
+        import nibabel as nib
+        vox_sd = np.sqrt(vox_m2 / max(n_t - 1, 1))
+        tsnr = np.divide(vox_mean, vox_sd, out=np.zeros_like(vox_sd), where=vox_sd > 0)
+        header = img.header.copy()
+        header.set_data_shape(img.shape[:3])
+        header.set_data_dtype(np.float32)
+        for name, values in [('_mean', vox_mean), ('_sd', vox_sd), ('_tsnr', tsnr)]:
+            volume = values.reshape(img.shape[:3], order="F").astype(np.float32)
+            nib.save(nib.Nifti1Image(volume, img.affine, header), maps_prefix + name + '.nii.gz')
+
+    return [float(mean), float(np.sqrt(m2 / max(n - 1, 1))), float(vmin), float(vmax)]
+
+def scan_subject(subject_path, subid):
+    '''
+        Manifest entry of one subject directory: its sessions, the files of each session
+        subdirectory (func, anat, ...) and the rows of its _sessions.tsv, with the mtimes
+        used to invalidate it.
+    '''
+    entry = {'mtime': os.stat(subject_path).st_mtime, 'sessions': {}, 'sessions_tsv': None}
+    with os.scandir(subject_path) as it:
+        for item in it:
+            if item.name.startswith('ses-') and item.is_dir():
+                session = {'mtime': item.stat().st_mtime, 'dirs': {}}
+                with os.scandir(item.path) as sub_it:
+                    for sub_item in sub_it:
+                        if sub_item.is_dir():
+                            session['dirs'][sub_item.name] = {'mtime': sub_item.stat().st_mtime,
+                                                              'files': sorted(os.listdir(sub_item.path))}
+                entry['sessions'][item.name[4:]] = session
+            elif item.name == 'sub-' + subid + '_sessions.tsv':
+                table = csv2pd(item.path)
+                entry['sessions_tsv'] = {'mtime': item.stat().st_mtime,
+                                         'header': list(table.columns),
+                                         'rows': table.values.tolist()}
+    return entry
+
+def subject_changed(subject_path, subid, entry):
+    '''
+        True if the subject directory changed since its manifest entry was made.
+        Only directory (and _sessions.tsv) mtimes are checked, not every file.
+    '''
+    if entry is None:
+        return True
+    try:
+        if os.stat(subject_path).st_mtime != entry['mtime']:
+            return True
+        for sesid, session in entry['sessions'].items():
+            session_path = subject_path + '/ses-' + sesid
+            if os.stat(session_path).st_mtime != session['mtime']:
+                return True
+            for name, subdir in session['dirs'].items():
+                if os.stat(session_path + '/' + name).st_mtime != subdir['mtime']:
+                    return True
+        if entry['sessions_tsv'] is not None:
+            sessions_tsv = subject_path + '/sub-' + subid + '_sessions.tsv'
+            if os.stat(sessions_tsv).st_mtime != entry['sessions_tsv']['mtime']:
+                return True
+    except OSError:
+        return True
+    return False
+
+def build_manifest(root=None, manifest_file=None, pipelines=("dhcp_fmri_pipeline", "dhcp_anat_pipeline"), threads=16,
+                   previous=None):
+    '''
+        Walks the dhcp pipeline directories once and indexes every subject, session and file,
+        plus the _sessions.tsv ages. Subjects are scanned in parallel with threads.
+        If manifest_file exists, only the subjects whose directory mtimes changed are scanned again,
+        and the updated manifest is written back to it (json). Pipelines of the previous manifest
+        that are not in pipelines are kept unchanged.
+        input:
+            root: str - dhcp root, dhcp_root() by default.
+            manifest_file: str - on-disk index, not saved if None.
+            previous: manifest dictionary to update instead of the one in manifest_file, e.g. of
+                the previous poll of a watcher (see landed_sessions).
+        output:
+            manifest: dictionary, see use_manifest.
+    '''
+    from concurrent.futures import ThreadPoolExecutor
+
+    if root is None:
+        root = dhcp_root()
+    if previous is None:
+        previous = {'root': root, 'pipelines': {}}
+        if manifest_file and os.path.exists(manifest_file):
+            with open(manifest_file) as fh:
+                previous = json.load(fh)
+    if previous.get('root') != root:
+            previous = {'root': root, 'pipelines': {}}
+
+    # pipelines not rescanned this time are kept as they were
+    result = {'root': root, 'pipelines': {pipeline: subjects for pipeline, subjects in previous['pipelines'].items()
+                                          if pipeline not in pipelines}}
+    with ThreadPoolExecutor(threads) as pool:
+        for pipeline in pipelines:
+            pipeline_dir = root + '/' + pipeline
+            if not os.path.isdir(pipeline_dir):
+                continue
+            subids = sorted(name[4:] for name in os.listdir(pipeline_dir) if name.startswith('sub-'))
+            old = previous['pipelines'].get(pipeline, {})
+
+            def update(subid):
+                subject_path = pipeline_dir + '/sub-' + subid
+                if subject_changed(subject_path, subid, old.get(subid)):
+                    return scan_subject(subject_path, subid)
+                return old[subid]
+
+            result['pipelines'][pipeline] = dict(zip(subids, pool.map(update, subids)))
+
+    if manifest_file:
+        partial = manifest_file + '.tmp-' + str(os.getpid())
+        with open(partial, 'w') as fh:
+            json.dump(result, fh)
+        os.replace(partial, manifest_file)
+    return result
+
+def landed_sessions(index, exclude=(), settle=60, compute_dvars=False):
+    '''
+        Sessions of a manifest whose censoring inputs have landed: the motion table and the
+        DVARS table (or, with compute_dvars, the BOLD image), all unmodified for settle seconds
+        so that files still being copied are left for a later poll.
+        input:
+            index: manifest dictionary (build_manifest), rebuilt incrementally by the caller.
+            exclude: (participant_id, session_id) sessions not to report, e.g. already processed.
+        output:
+            sorted list of (participant_id, session_id).
+    '''
+    landed = list()
+    now = time.time()
+    for subid, entry in index['pipelines'].get('dhcp_fmri_pipeline', {}).items():
+        for sesid, session in entry['sessions'].items():
+            if (subid, sesid) in exclude:
+                continue
+            files = set(session['dirs'].get('func', {}).get('files', []))
+            prefix = 'sub-' + subid + '_ses-' + sesid
+            if prefix + '_motion.tsv' not in files:
+                continue
+            if prefix + 'DVARS.csv' in files:
+                inputs = [prefix + '_motion.tsv', prefix + 'DVARS.csv']
+            elif compute_dvars and prefix + '_task-rest_desc-preproc_bold.nii.gz' in files:
+                inputs = [prefix + '_motion.tsv', prefix + '_task-rest_desc-preproc_bold.nii.gz']
+            else:
+                continue
+            func_dir = index['root'] + '/dhcp_fmri_pipeline/sub-' + subid + '/ses-' + sesid + '/func/'
+            try:
+                if all(now - os.stat(func_dir + name).st_mtime >= settle for name in inputs):
+                    landed.append((subid, sesid))
+            except FileNotFoundError:
+                continue
+    return sorted(landed)
+
+# manifest answering the path and age helpers, see use_manifest.
+manifest = None
+manifest_files = set()
+
+def use_manifest(index):
+    '''
+        Makes get_niftiPath, get_scanage, get_sesid and file_exists answer from a manifest
+        instead of the filesystem.
+        input:
+            index: manifest dictionary (build_manifest) or path to a saved manifest. None to stop using it.
+    '''
+    global manifest, manifest_files
+    if isinstance(index, str):
+        with open(index) as fh:
+            index = json.load(fh)
+    manifest = index
+    manifest_files = set()
+    if index is None:
+        return
+    for pipeline, subjects in index['pipelines'].items():
+        for subid, entry in subjects.items():
+            for sesid, session in entry['sessions'].items():
+                session_path = index['root'] + '/' + pipeline + '/sub-' + subid + '/ses-' + sesid
+                for name, subdir in session['dirs'].items():
+                    manifest_files.update(session_path + '/' + name + '/' + fname for fname in subdir['files'])
+
+def manifest_subject(subid, pipeline="dhcp_fmri_pipeline"):
+    '''
+        Manifest entry of a subject, None if not indexed or no manifest is in use.
+    '''
+    if manifest is None:
+        return None
+    return manifest['pipelines'].get(pipeline, {}).get(subid)
+
+def session_files(subid, sesid):
+    '''
+        Canonical paths of the files of a session: preprocessed BOLD image, motion table,
+        DVARS table and cropped BOLD image (see cropped_path).
+    '''
+    session_path = dhcp_root() + "/dhcp_fmri_pipeline/sub-" + subid + "/ses-" + sesid + '/func/sub-' + subid + '_ses-' + sesid
+    return {'bold': session_path + '_task-rest_desc-preproc_bold.nii.gz',
+            'motion': session_path + '_motion.tsv',
+            'dvars': session_path + 'DVARS.csv',
+            'cropped': cropped_path(subid, sesid)}
+
+def get_sessions(subid, pipeline="dhcp_fmri_pipeline"):
+    '''
+        Returns the sorted session ids (without 'ses-') of a subject, from the manifest if in use.
+    '''
+    entry = manifest_subject(subid, pipeline)
+    if entry is not None:
+        return sorted(entry['sessions'])
+    subject_path = dhcp_root() + '/' + pipeline + '/sub-' + subid
+    if not os.path.exists(subject_path):
+        return []
+    return sorted(name[4:] for name in os.listdir(subject_path) if name[0:3] == 'ses')
+
+def file_exists(path):
+    '''
+        os.path.exists answered from the manifest for paths in its pipeline directories.
+    '''
+    if manifest is not None:
+        for pipeline in manifest['pipelines']:
+            if path.startswith(manifest['root'] + '/' + pipeline + '/'):
+                return path in manifest_files
+    count('stat_calls')
+    with timed('fs_metadata'):
+        return os.path.exists(path)
+
+def file_key(path, content_hash=False):
+    '''
+        Identity of a file for qc_cache_key: its size and mtime, or the sha1 of its content
+        if content_hash. None if the file does not exist.
+    '''
+    try:
+        if content_hash:
+            digest = hashlib.sha1()
+            with open(path, 'rb') as fh:
+                for block in iter(lambda: fh.read(1 << 20), b''):
+                    digest.update(block)
+            return digest.hexdigest()
+        st = os.stat(path)
+        return str(st.st_size) + ':' + str(st.st_mtime_ns)
+    except OSError:
+        return None
+
+def qc_cache_key(paths, params, content_hash=False):
+    '''
+        Cache key of a session's QC results: the identity of its input files (see file_key)
+        and the censoring parameters (a dictionary).
+    '''
+    ident = [[file_key(path, content_hash) for path in paths], params]
+    return hashlib.sha1(json.dumps(ident, sort_keys=True).encode()).hexdigest()
+
+def load_qc_cache(cache_file, max_entries=100000):
+    '''
+        Loads the per-session QC cache (mean_fd, mean_dvars, outliers, best window...) from
+        cache_file, or starts an empty one. Entries are kept in least recently used order and
+        the oldest are evicted past max_entries.
+    '''
+    entries = OrderedDict()
+    if cache_file and os.path.exists(cache_file):
+        with open(cache_file) as fh:
+            entries = OrderedDict(json.load(fh)['entries'])
+    return {'file': cache_file, 'max_entries': max_entries, 'entries': entries}
+
+def qc_cache_get(cache, key):
+    '''
+        Cached QC results for key, None on a miss.
+    '''
+    value = cache['entries'].get(key)
+    if value is not None:
+        cache['entries'].move_to_end(key)
+    return value
+
+def qc_cache_put(cache, key, value):
+    '''
+        Stores the QC results (a json-serializable dictionary) for key, evicting the least recently used.
+    '''
+    cache['entries'][key] = value
+    cache['entries'].move_to_end(key)
+    while len(cache['entries']) > cache['max_entries']:
+        cache['entries'].popitem(last=False)
+
+def save_qc_cache(cache):
+    '''
+        Writes the QC cache back to its file, replacing it atomically.
+    '''
+    partial = cache['file'] + '.tmp-' + str(os.getpid())
+    with open(partial, 'w') as fh:
+        json.dump({'entries': list(cache['entries'].items())}, fh)
+    os.replace(partial, cache['file'])
+
+def array_job_shard():
+    '''
+        [shard_index, shard_count] of this task of a slurm (SLURM_ARRAY_TASK_*) or SGE (SGE_TASK_*)
+        job array, None outside of a job array.
+    '''
+    env = os.environ
+    if env.get('SLURM_ARRAY_TASK_ID') and env.get('SLURM_ARRAY_TASK_COUNT'):
+        first = int(env.get('SLURM_ARRAY_TASK_MIN', 0))
+        return [int(env['SLURM_ARRAY_TASK_ID']) - first, int(env['SLURM_ARRAY_TASK_COUNT'])]
+    if env.get('SGE_TASK_ID', 'undefined') != 'undefined' and env.get('SGE_TASK_LAST', 'undefined') != 'undefined':
+        first = int(env.get('SGE_TASK_FIRST', 1))
+        step = int(env.get('SGE_TASK_STEPSIZE', 1))
+        return [(int(env['SGE_TASK_ID']) - first) // step, (int(env['SGE_TASK_LAST']) - first) // step + 1]
+    return None
+
+def shard_assignment(sizes, shard_count):
+    '''
+        Balances items over shard_count shards by size (e.g. expected file size of each session),
+        greedily giving the largest remaining item to the lightest shard. Deterministic: ties are
+        broken by item position and shard index, so every shard computes the same assignment.
+        returns a list with the shard index of each item.
+    '''
+    loads = [0] * shard_count
+    assignment = [0] * len(sizes)
+    for i in sorted(range(len(sizes)), key=lambda i: (-sizes[i], i)):
+        shard = min(range(shard_count), key=lambda shard: (loads[shard], shard))
+        assignment[i] = shard
+        loads[shard] = loads[shard] + sizes[i]
+    return assignment
+
+def shard_root(root, shard_index, shard_count):
+    '''
+        File root of the partial results of a shard, e.g. rel2_dvars.shard-3-of-20.
+    '''
+    return root + '.shard-' + str(shard_index) + '-of-' + str(shard_count)
+
+def write_shard(root, shard_index, shard_count, table, positions, assigned, failed):
+    '''
+        Writes the partial results of a shard: the table (.pkl) and the sessions it was assigned,
+        their positions in the input table and the ones that failed (.json).
+        Sessions are [participant_id, session_id] pairs.
+    '''
+    partial = shard_root(root, shard_index, shard_count)
+    table.to_pickle(partial + '.pkl')
+    with open(partial + '.json', 'w') as fh:
+        json.dump({'shard_index': shard_index, 'shard_count': shard_count, 'positions': positions,
+                   'assigned': [[str(pid), str(sid)] for pid, sid in assigned],
+                   'failed': [[str(pid), str(sid)] for pid, sid in failed]}, fh)
+
+def merge_shards(root, shard_count, participants=None):
+    '''
+        Combines the partial results of shard_count shards (see write_shard) into one table,
+        in the order of the input table, and checks that nothing was dropped or duplicated:
+        every shard is present, no session was assigned twice or is missing from the assignments
+        (if participants, the input table, is given), and every assigned session is in the results
+        or failed.
+        returns [table, failed]. Raises ValueError if the checks fail.
+    '''
+    tables = list()
+    positions = list()
+    failed = list()
+    assigned = dict()
+    for shard_index in range(shard_count):
+        partial = shard_root(root, shard_index, shard_count)
+        if not os.path.exists(partial + '.json') or not os.path.exists(partial + '.pkl'):
+            raise ValueError("Missing results of shard " + str(shard_index) + ": " + partial)
+        with open(partial + '.json') as fh:
+            meta = json.load(fh)
+        table = pd.read_pickle(partial + '.pkl')
+        for session in map(tuple, meta['assigned']):
+            if session in assigned:
+                raise ValueError("Session " + str(session) + " assigned to shards " + str(assigned[session]) +
+                                 " and " + str(shard_index))
+            assigned[session] = shard_index
+        keys = list(zip(table['participant_id'].astype(str), table['session_id'].astype(str)))
+        position_of = dict(zip(map(tuple, meta['assigned']), meta['positions']))
+        shard_failed = set(map(tuple, meta['failed']))
+        missing = set(position_of) - set(keys) - shard_failed
+        if missing or len(set(keys)) != len(keys) or not set(keys) <= set(position_of):
+            raise ValueError("Shard " + str(shard_index) + " results do not match its sessions. Missing: " +
+                             str(sorted(missing)))
+        tables.append(table)
+        positions.extend(position_of[key] for key in keys)
+        failed.extend(sorted(shard_failed))
+
+    if participants is not None:
+        expected = set(zip(participants['participant_id'].astype(str), participants['session_id'].astype(str)))
+        if expected != set(assigned):
+            raise ValueError("Sessions not assigned to any shard: " + str(sorted(expected - set(assigned))) +
+                             ", unknown sessions: " + str(sorted(set(assigned) - expected)))
+    merged = pd.concat(tables, ignore_index=True)
+    merged = merged.iloc[np.argsort(positions, kind='stable')].reset_index(drop=True)
+    return [merged, failed]
+
+#########################################################################
+# Crop journal
+#
+# A journal is a json lines file with one record per session event: started,
+# done (with the output table row, the cropped image, its size and sha256) or
+# failed (with the error). Records are flushed to disk as they are written, so
+# after a killed run the last record of each session tells where it stopped.
+
+journal_lock = threading.Lock()
+
+def journal_write(journal_file, record):
+    '''
+        Appends a record to a journal, on disk before returning. Thread-safe.
+        record: dictionary with participant_id, session_id and status (started, done or failed).
+    '''
+    record = dict(record, session_id=str(record['session_id']), time=time.time())
+    # numpy scalars of table rows as python numbers
+    line = json.dumps(record, default=lambda value: value.item()) + '\n'
+    with journal_lock, open(journal_file, 'a') as fh:
+        fh.write(line)
+        fh.flush()
+        os.fsync(fh.fileno())
+
+def journal_state(journal_file):
+    '''
+        Last record of each session of a journal, {(participant_id, session_id): record}.
+        A torn last line, from a run killed while writing it, is ignored.
+    '''
+    state = OrderedDict()
+    if not os.path.exists(journal_file):
+        return state
+    with open(journal_file) as fh:
+        for line in fh:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            key = (record['participant_id'], record['session_id'])
+            state.pop(key, None)
+            state[key] = record
+    return state
+
+def file_sha256(path):
+    '''
+        sha256 of the content of a file, read in blocks.
+    '''
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        for block in iter(lambda: fh.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def journal_done(record, verify=False):
+    '''
+        True if a journal record is a completed session whose output is still in place with
+        the journaled size, and sha256 if verify.
+    '''
+    if record is None or record['status'] != 'done':
+        return False
+    output = record.get('output')
+    if output is None:
+        return True
+    try:
+        if os.path.getsize(output) != record['size']:
+            return False
+    except OSError:
+        return False
+    return not verify or file_sha256(output) == record['sha256']
+
+def journal_table(journal_file, sessions=None, columns=None, verify=False):
+    '''
+        Output table rebuilt from the rows of the completed sessions of a journal (journal_done),
+        in the order of sessions ([participant_id, session_id] list) or of completion.
+    '''
+    state = journal_state(journal_file)
+    if sessions is None:
+        keys = list(state)
     else:
-        subject_dvars = csv2pd(csvfile)
-        subject_dvars = subject_dvars.astype(float)
-        mean_dvars = np.mean(subject_dvars[1:])[0]
-        #zscore = stats.zscore(subject_dvars['0']) wrong
-        min_volsOver = 1600
-        keep_vols = 1600
-        BOLD_length = 2299
-        #threshold = 1.5*stats.iqr(zscore) + np.percentile(zscore, 75) wrong
-        threshold = 1.5 * stats.iqr(subject_dvars[1:]) + np.percentile(subject_dvars[1:], 75)
-
-        min_idx = 0
-        for i in range (BOLD_length-keep_vols):
-            previous_min = min_volsOver
-            #print(np.count_nonzero((subject_dvars[i:i+1600]) > threshold))
-            min_volsOver = min(min_volsOver, np.count_nonzero(subject_dvars[i:i+keep_vols] > threshold))
-            if previous_min != min_volsOver:
-                    min_idx = i
-    return [min_volsOver, min_idx, mean_dvars]
+        keys = [(str(subid), str(sesid)) for subid, sesid in sessions]
+    rows = [state[key]['row'] for key in keys if journal_done(state.get(key), verify)]
+    return pd.DataFrame(rows, columns=columns)
 
 def get_niftiPath(participant_id, session="bold"):
     '''
@@ -181,8 +1644,17 @@ def get_niftiPath(participant_id, session="bold"):
     :param session: a string either 'bold' or 'dmri', 'anat' NOT IMPLEMENTED
     :return niftiPath: a string containing the full boldPath
     returns false if no sessions or multiple sessions.
+    Answers from the manifest if in use (see use_manifest), with the first session.
     '''
 
+    entry = manifest_subject(participant_id)
+    if entry is not None:
+        if not entry['sessions']:
+            return False
+        session_name = 'ses-' + sorted(entry['sessions'])[0]
+        return (manifest['root'] + '/dhcp_fmri_pipeline/sub-' + participant_id + '/' + session_name +
+                '/func/sub-' + participant_id + '_' + session_name + '_task-rest_desc-preproc_bold.nii.gz')
+
     dhcp_dir = '/geode2/home/u020/dderman/Carbonate/dHCP_dataset/'
     #dhcp_dir = '/N/project/baby_ICA/'
     nosessions_flag = False
@@ -209,128 +1681,255 @@ def get_niftiPath(participant_id, session="bold"):
 
     return niftiPath
 
-def csv2dict(participants_path):
+def sniff_delimiter(header_line):
+    '''
+        Delimiter of a dhcp table from its header line: tab, or comma for the csv files
+        (and malformed tsv files) whose header does not split on tabs.
+    '''
+    if "\t" in header_line:
+        return "\t"
+    if "," in header_line:
+        return ","
+    return "\t"
+
+def read_table(path, dtype=None, usecols=None, **kwargs):
+    '''
+        Reads a tsv/csv table straight into typed columns with the pandas C parser.
+        The delimiter is sniffed once from the header line, see sniff_delimiter.
+        input:
+            path: str - table path.
+            dtype: type or dict - forced column types, inferred by default (numbers are float/int).
+            usecols: list - columns to read, all by default.
+            kwargs: passed to pandas.read_csv.
+        output:
+            pandas dataframe
+    '''
+    with timed('read_table'), open(path, newline='') as fh:
+        count('bytes_read', os.fstat(fh.fileno()).st_size)
+        sep = sniff_delimiter(fh.readline())
+        fh.seek(0)
+        return pd.read_csv(fh, sep=sep, dtype=dtype, usecols=usecols, **kwargs)
+
+def read_trace(path, column=0):
+    '''
+        Reads one column of a per-session table (DVARS csv, motion tsv) as a float array.
+        column: int or str - column position or name.
+        As with csv2pd, the first line is the header.
     '''
+    if isinstance(column, int):
+        return read_table(path, dtype=float).iloc[:, column].to_numpy()
+    return read_table(path, dtype=float, usecols=[column])[column].to_numpy()
 
-    returns an array of dictionaries
+def read_tables(paths, threads=8, **kwargs):
+    '''
+        Bulk mode of read_table: reads many per-subject tables in one call with a thread pool.
+        kwargs are passed to read_table. Returns the dataframes in the order of paths.
+    '''
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(threads) as pool:
+        return list(pool.map(lambda path: read_table(path, **kwargs), paths))
 
-    #with open(dhcp_dir + 'dhcp_fmri_pipeline/participants.tsv') as csvfile:#, newline='') as csvfile:
-    with open(participants_path, newline='\n') as csvfile:
-        reader = csv.reader(csvfile, delimiter='\t')#, quotechar='')
-        for row in reader:
-            key = row[0]
-            if key in participants:
-                print("duplicado")
-                pass
+def csv2dict(participants_path):
+    '''
+        returns a list of dictionaries, one per row, with the values as strings.
     '''
-    #participants = list()
-    participants = list()
-    with open(participants_path) as input_file:
-        reader = csv.DictReader(input_file,  delimiter='\t')
-        for row in reader:
-            #participants.append(row)
-            participants.append(row) # table is a numpy array of dictionaries.
-    #return np.asarray(participants)
-    return participants
+    return csv2pd(participants_path).to_dict('records')
 
 def csv2pd(participants_path):
     '''
+        Legacy all-string reader, prefer read_table for typed columns.
+        :return: pandas dataframe with every value as a string
+    '''
+    return read_table(participants_path, dtype=str, keep_default_na=False)
 
-    :param dictionary:
-    :return: returns an array where [subject_index][field_index][0] is field name and [subject_index][field_index][1] is value
+def longest_runs(mask):
+    '''
+        Run-length encoding of the True runs of each row of a boolean array.
+        input:
+            mask: bool array - frames, or rows x frames.
+        output:
+            [length, start]: int arrays, one value per row, of the longest run and the index where
+            the (first) longest run starts. Rows without True have length 0 and start -1.
     '''
+    mask = np.atleast_2d(mask)
+    rows = mask.shape[0]
+    # pad with False so that every run has a rising and a falling edge.
+    padded = np.zeros((rows, mask.shape[1] + 2), dtype=np.int8)
+    padded[:, 1:-1] = mask
+    edges = np.diff(padded, axis=1)
+    run_row, run_start = np.nonzero(edges == 1)
+    run_end = np.nonzero(edges == -1)[1]
+    run_length = run_end - run_start
 
-    result = list()
+    length = np.zeros(rows, dtype=int)
+    start = np.full(rows, -1)
+    if len(run_row):
+        # per row, the longest run and, among ties, the first one.
+        order = np.lexsort((run_start, -run_length, run_row))
+        first = order[np.r_[True, run_row[order][1:] != run_row[order][:-1]]]
+        length[run_row[first]] = run_length[first]
+        start[run_row[first]] = run_start[first]
+    return [length, start]
 
-    with open(participants_path, newline='\n') as csvfile:
-        reader = csv.reader(csvfile, delimiter='\t')  # , quotechar='')
-        #headers = next(reader)[0]
-        headers = next(reader)
-        if len(headers) == 1: # Needed for malformed csv files whose headers can't be read.
-            headers = headers[0].split(",")
-            headers = list(headers)
-            for row in reader:
-                line_list = row[0].split(",")
-                result.append(line_list)
-        else:
-            for row in reader:
-                result.append(row)
-    dataframe = pd.DataFrame(result, columns=headers)
-    return dataframe
+def longest_streak(participant_fd, threshold):
+    '''
+        Longest streak of consecutive frames with framewise displacement under threshold.
+        input:
+            participant_fd: dataframe with a framewise_displacement column, a 1-D array,
+                or a subjects x frames array (NaN frames break streaks).
+            threshold: float
+        output:
+            [streak, start]: length and first frame of the longest streak, arrays for 2-D input.
+    '''
+    if isinstance(participant_fd, pd.DataFrame):
+        participant_fd = participant_fd['framewise_displacement'].to_numpy(dtype=float)
+    participant_fd = np.asarray(participant_fd, dtype=float)
+    streak, start = longest_runs(participant_fd < threshold)
+    if participant_fd.ndim == 1:
+        return [int(streak[0]), int(start[0])]
+    return [streak, start]
+
+def streak_table(fd, thresholds, subjects=None):
+    '''
+        Longest low-motion streaks of many subjects at many thresholds at once.
+        input:
+            fd: subjects x frames array of framewise displacement (NaN padded if lengths differ).
+            thresholds: list of float
+            subjects: labels of the rows, e.g. participant ids.
+        output:
+            [streaks, starts]: subjects x thresholds dataframes of streak lengths and start frames.
+    '''
+    fd = np.atleast_2d(np.asarray(fd, dtype=float))
+    thresholds = np.asarray(thresholds, dtype=float)
+    # one row per subject and threshold
+    mask = (fd[:, None, :] < thresholds[None, :, None]).reshape(-1, fd.shape[1])
+    streak, start = longest_runs(mask)
+    shape = (fd.shape[0], len(thresholds))
+    streaks = pd.DataFrame(streak.reshape(shape), index=subjects, columns=thresholds)
+    starts = pd.DataFrame(start.reshape(shape), index=subjects, columns=thresholds)
+    return [streaks, starts]
 
 def get_longeststreak(participant_fd, threshold):
     '''
 
     :param participant_fd: framewise displacement has to be flaot
     :param threshold: float
-    :return: longest streak
-    '''
-    thresholded_array = (participant_fd['framewise_displacement'] < threshold).values
-    i = amount_true = streak = 0
-    while i < (len(thresholded_array) -1) :
-        if thresholded_array[i]:
-            changes = np.diff(thresholded_array[i:])
-            amount_true = np.argmax(changes)
-            if sum(np.logical_not(changes)) == len(changes):  # Important to try and eliminate the need for this if
-                amount_true = len(changes)
-            streak = max([streak, amount_true])
-            i = i + amount_true
-        else:
-            i = i + 1
-        if amount_true == 0:
-            i = i + 1
-
-    return streak
-
-def boldstats(subjects_directory = "/N/project/baby_ICA/dhcp_fmri_cropped", save_pickle = False, save_csv = False):
-	'''
-	subjects_directory = "/N/project/baby_ICA/dhcp_fmri_cropped" - directory of fmri data 
-	save_pickle = False - If not false saves data to pickle in save_pickle
-	save_csv = False - If not false saves data to csv in save_csv
-	Calls for FSL on linux and returns a pandas dataframe with the stats of the bold timeseries
-	 
-	
-	
-	
-	'''
-	
-	#dhcp_root = "/N/project/baby_ICA"
-	subject_list = os.listdir(subjects_directory)
-
-	pl = pd.DataFrame({"subject": subject_list})
-	pl.insert(1, "mean", -1)
-	pl.insert(2, "sd", -1)
-	pl.insert(3, "min", -1)
-	pl.insert(4, "max", -1)
-
-	for subject in subject_list:
-		process = subprocess.Popen(
-			["fslstats " + get_niftiPath(subject) + " -m -s -R"], shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-		stdout, stderr = process.communicate()
-		outline = stdout.decode("utf-8").split(' ')
-		pl.loc[pl["subject"] == subject, "mean"] = float(outline[0])
-		pl.loc[pl["subject"] == subject, "sd"] = float(outline[1])
-		pl.loc[pl["subject"] == subject, "min"] = float(outline[2])
-		pl.loc[pl["subject"] == subject, "max"] = float(outline[3])
-	
-	if save_pickle:
-		pl.to_pickle(save_pickle)
-	
-	if save_csv:
-		pl.to_csv(save_csv)
-
-	return(pl)
-
-def get_scanage(subid):
-    '''
-        Returns the age at scan for the first session of the subject.
-        TODO: handle multiple sessions
+    :return: longest streak, in frames. See longest_streak for its start.
+    '''
+    return longest_streak(participant_fd, threshold)[0]
+
+def fslstats_mean_sd_range(bold):
+    '''
+        [mean, sd, min, max] of an image with fslstats -m -s -R (FSL fallback of bold_image_stats).
+    '''
+    with timed('fslstats', subprocess_call=True):
+        process = subprocess.Popen(["fslstats", bold, "-m", "-s", "-R"], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = process.communicate()
+    return [float(value) for value in stdout.decode("utf-8").split()[0:4]]
+
+def boldstats(subjects_directory = "/N/project/baby_ICA/dhcp_fmri_cropped", save_pickle = False, save_csv = False,
+              threads = 8, maps_directory = None, method = "native"):
+    '''
+    subjects_directory = "/N/project/baby_ICA/dhcp_fmri_cropped" - directory of fmri data
+    save_pickle = False - If not false saves data to pickle in save_pickle
+    save_csv = False - If not false saves data to csv in save_csv
+    threads = 8 - subjects processed at the same time
+    maps_directory = None - If set, also writes voxelwise mean, sd and tSNR maps of each subject there
+    method = "native" - streaming bold_image_stats, or "fsl" for fslstats -m -s -R (no maps)
+    Returns a pandas dataframe with the stats of the bold timeseries (subject, mean, sd, min, max)
+    '''
+    from concurrent.futures import ProcessPoolExecutor
+
+    subject_list = os.listdir(subjects_directory)
+    bold_list = [get_niftiPath(subject) for subject in subject_list]
+
+    if method == "fsl":
+        jobs = [[fslstats_mean_sd_range, bold] for bold in bold_list]
+    else:
+        if maps_directory:
+            os.makedirs(maps_directory, exist_ok=True)
+        jobs = [[bold_image_stats, bold, 64, maps_directory + '/' + subject if maps_directory else None]
+                for subject, bold in zip(subject_list, bold_list)]
+
+    with ProcessPoolExecutor(threads) as pool:
+        stats_list = list(pool.map(call_job, jobs))
+
+    # columnar, one array per statistic
+    stats_array = np.array(stats_list, dtype=float).reshape(-1, 4)
+    pl = pd.DataFrame({"subject": subject_list,
+                       "mean": stats_array[:, 0],
+                       "sd": stats_array[:, 1],
+                       "min": stats_array[:, 2],
+                       "max": stats_array[:, 3]})
+
+    if save_pickle:
+        pl.to_pickle(save_pickle)
+
+    if save_csv:
+        pl.to_csv(save_csv)
+
+    return(pl)
+
+def call_job(job):
+    '''
+        Calls job[0](*job[1:]), for pool.map over jobs with different functions or arguments.
+    '''
+    return job[0](*job[1:])
+
+def stage(function, items, executor=None, depth=8):
+    '''
+        One stage of a streaming pipeline: lazily maps function over items (e.g. the generator of
+        the previous stage) on an executor (thread or process pool), yielding results in order.
+        At most depth items are queued or running ahead of the consumer, so a slow consumer stops
+        the stages before it (backpressure) and memory stays bounded. Without an executor, items
+        are processed one at a time as they are consumed.
+    '''
+    from collections import deque
+
+    items = iter(items)
+    if executor is None:
+        for item in items:
+            yield function(item)
+        return
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(function, item))
+        if len(pending) >= depth:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+def prefetch(function, items, threads=4, depth=16):
+    '''
+        Reads ahead: stage on its own pool of threads, for I/O bound functions (e.g. reading the
+        tables of the next sessions while the current ones are scored).
+    '''
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(threads) as pool:
+        yield from stage(function, items, pool, depth)
+
+def get_scanage(subid, sesid=None):
+    '''
+        Returns the age at scan for the first session of the subject, or for session sesid.
+        Answers from the manifest if in use (see use_manifest).
         input:
             subid: str - subject id
+            sesid: str - session id, first session if None.
         output:
             age: float - returns age at scan, 0 if not found.
     '''
+    entry = manifest_subject(subid)
+    if entry is not None:
+        rows = entry['sessions_tsv']['rows'] if entry['sessions_tsv'] is not None else []
+        for row in rows:
+            if sesid is None or str(row[0]) == str(sesid):
+                return float(row[1])
+        print("Session not found.")
+        return 0.0
+
     age = 0
+    amount_sessions = 0
     subid = 'sub-' + subid # Incomplete name in subject_table.
     subject_path = dhcp_root() + "/dhcp_fmri_pipeline/" + subid
     if os.path.exists(subject_path):
@@ -344,8 +1943,10 @@ def get_scanage(subid):
             with open(session_info, newline='\n') as csvfile:
                 reader = csv.reader(csvfile, delimiter='\t')  # , quotechar='')
                 headers = next(reader) # Read headers for future functionality
-                first_session = next(reader)
-                age = first_session[1]
+                for session in reader:
+                    if sesid is None or session[0] == str(sesid):
+                        age = session[1]
+                        break
     else:
         print("Subject not found.")
 
@@ -353,14 +1954,20 @@ def get_scanage(subid):
 
 def get_sesid(subid):
     '''
-        Returns the age at scan for the first session of the subject.
-        TODO: handle multiple sessions
+        Returns the session directory name (ses-...) of the subject.
+        Answers from the manifest if in use (see use_manifest), with the first session,
+        see get_sessions for all of them.
         input:
             subid: str - subject id
         output:
-            age: float - returns age at scan, 0 if not found.
+            sesid: str
     '''
-    age = 0
+    entry = manifest_subject(subid)
+    if entry is not None and entry['sessions']:
+        return 'ses-' + sorted(entry['sessions'])[0]
+
+    sesid = None
+    amount_sessions = 0
     subid = 'sub-' + subid # Incomplete name in subject_table.
     subject_path = dhcp_root() + "/dhcp_fmri_pipeline/" + subid
     if os.path.exists(subject_path):
@@ -384,3 +1991,479 @@ def generate_fullpaths(sufix, subject_list):
             subject_list: pkl - pkl file with a list of subjects.
     '''
 
+#########################################################################
+# Columnar results store
+#
+# A store is a directory with one raw binary file per column and a meta.json
+# with the column names, dtypes and the amount of rows. Numeric columns are
+# read as memory maps, strings are stored as fixed-width utf-8 bytes. Appends
+# write the columns first and the row count last, so an interrupted append
+# leaves the store at its previous length. A promoted (widened) column is
+# rewritten to a new file that meta.json switches to. Missing strings (None, NaN) are
+# stored as STORE_MISSING, which no utf-8 string encodes to.
+
+STORE_MISSING = b'\xff'
+
+def store_meta(store_dir):
+    '''
+        meta.json of a store, None if the store does not exist.
+    '''
+    meta_file = store_dir + '/meta.json'
+    if not os.path.exists(meta_file):
+        return None
+    with open(meta_file) as fh:
+        return json.load(fh)
+
+def store_write_meta(store_dir, meta):
+    with open(store_dir + '/meta.json.tmp', 'w') as fh:
+        json.dump(meta, fh)
+    os.replace(store_dir + '/meta.json.tmp', store_dir + '/meta.json')
+
+def store_column_file(store_dir, i, column):
+    '''
+        Data file of the i-th column of a store.
+    '''
+    return store_dir + '/' + column.get('file', str(i) + '.bin')
+
+def store_encode(values, width=None):
+    '''
+        numpy array of a dataframe column for the store: numbers and booleans as they are,
+        anything else as fixed-width utf-8 bytes (at least width wide), missing values as STORE_MISSING.
+    '''
+    values = np.asarray(values)
+    if values.dtype.kind in 'biuf':
+        return values
+    encoded = [STORE_MISSING if item is None or (isinstance(item, float) and np.isnan(item)) else str(item).encode('utf-8')
+               for item in values]
+    longest = max([len(item) for item in encoded] + [width or 1])
+    return np.array(encoded, dtype='S' + str(longest))
+
+def store_append(store_dir, dataframe):
+    '''
+        Appends the rows of a dataframe to a columnar store, creating it if needed.
+        The columns must match the store's. Columns are promoted if needed (strings widened,
+        integers to floats, e.g. for NaN), never cast to a type that loses values. Raises
+        ValueError for strings appended to a numeric column or numbers to a string column.
+    '''
+    os.makedirs(store_dir, exist_ok=True)
+    meta = store_meta(store_dir)
+    if meta is None:
+        meta = {'rows': 0, 'columns': [{'name': str(name), 'dtype': None} for name in dataframe.columns]}
+    names = [column['name'] for column in meta['columns']]
+    if names != [str(name) for name in dataframe.columns]:
+        raise ValueError("Columns " + str(list(dataframe.columns)) + " do not match the store " + str(names))
+
+    # all the columns are checked before anything is written
+    encoded = list()
+    for i, column in enumerate(meta['columns']):
+        old_dtype = np.dtype(column['dtype']) if column['dtype'] else None
+        width = old_dtype.itemsize if old_dtype is not None and old_dtype.kind == 'S' else None
+        values = store_encode(dataframe.iloc[:, i].to_numpy(), width)
+        if old_dtype is not None and values.dtype != old_dtype:
+            if (old_dtype.kind == 'S') != (values.dtype.kind == 'S'):
+                raise ValueError("Column " + column['name'] + " of the store is " + str(old_dtype) +
+                                 ", cannot append " + str(values.dtype) + " values")
+            values = values.astype(np.result_type(old_dtype, values.dtype))
+        encoded.append([old_dtype, values])
+
+    stale = list()
+    for i, [column, [old_dtype, values]] in enumerate(zip(meta['columns'], encoded)):
+        fname = store_column_file(store_dir, i, column)
+        if old_dtype is not None and values.dtype != old_dtype:
+            # promote (widen) the existing values into a new file, the old one stays valid until meta.json switches
+            generation = column.get('generation', 0) + 1
+            promoted = str(i) + '.' + str(generation) + '.bin'
+            previous = np.fromfile(fname, dtype=old_dtype, count=meta['rows']).astype(values.dtype)
+            with open(store_dir + '/' + promoted, 'wb') as fh:
+                fh.write(np.ascontiguousarray(previous).tobytes())
+                fh.write(np.ascontiguousarray(values).tobytes())
+            stale.append(fname)
+            column['file'] = promoted
+            column['generation'] = generation
+        else:
+            with open(fname, 'ab') as fh:
+                # drop leftovers of an interrupted append
+                fh.truncate(meta['rows'] * values.dtype.itemsize)
+                fh.write(np.ascontiguousarray(values).tobytes())
+        column['dtype'] = values.dtype.str
+    meta['rows'] = meta['rows'] + len(dataframe)
+    store_write_meta(store_dir, meta)
+    for fname in stale:
+        os.remove(fname)
+
+def store_write(store_dir, dataframe):
+    '''
+        Writes a dataframe as a new columnar store, replacing any previous one.
+    '''
+    if os.path.isdir(store_dir):
+        rmtree(store_dir)
+    store_append(store_dir, dataframe)
+
+def store_arrays(store_dir, columns=None):
+    '''
+        Memory-mapped column arrays of a store, only for the requested columns.
+        Strings stay as bytes arrays, see store_read to decode them.
+        output:
+            dictionary of column name to numpy memmap.
+    '''
+    meta = store_meta(store_dir)
+    if meta is None:
+        raise FileNotFoundError("No results store at " + store_dir)
+    names = [column['name'] for column in meta['columns']]
+    if columns is None:
+        columns = names
+    arrays = dict()
+    for name in columns:
+        if name not in names:
+            raise ValueError("Unknown column " + name + ". Columns: " + ", ".join(names))
+        i = names.index(name)
+        dtype = np.dtype(meta['columns'][i]['dtype'])
+        if meta['rows'] == 0:
+            arrays[name] = np.zeros(0, dtype=dtype)
+        else:
+            arrays[name] = np.memmap(store_column_file(store_dir, i, meta['columns'][i]), dtype=dtype, mode='r',
+                                     shape=(meta['rows'],))
+    return arrays
+
+def store_read(store_dir, columns=None):
+    '''
+        Reads a columnar store as a pandas dataframe, only the requested columns
+        (all by default). Strings are decoded, numeric columns come from memory maps.
+    '''
+    arrays = store_arrays(store_dir, columns)
+    data = dict()
+    for name, values in arrays.items():
+        if values.dtype.kind == 'S':
+            missing = np.asarray(values) == STORE_MISSING
+            data[name] = np.where(missing, None, np.char.decode(np.where(missing, b'', values), 'utf-8').astype(object))
+        else:
+            data[name] = np.asarray(values)
+    return pd.DataFrame(data)
+
+def load_table(path, columns=None):
+    '''
+        Loads a results table from a columnar store directory, a pickle (.pkl) or a csv/tsv.
+    '''
+    if os.path.isdir(path):
+        return store_read(path, columns)
+    if path.endswith('.pkl'):
+        with open(path, 'rb') as fh:
+            table = pickle.load(fh)
+    else:
+        table = read_table(path)
+        if table.columns[0].startswith('Unnamed'):
+            # index column written by to_csv
+            table = table.drop(columns=table.columns[0])
+    return table if columns is None else table[columns]
+
+def store_import(path, store_dir):
+    '''
+        Converts an existing pickle or csv table (e.g. rel2_dvars.pkl) into a columnar store.
+    '''
+    store_write(store_dir, load_table(path))
+
+def store_export(store_dir, path):
+    '''
+        Exports a columnar store to a pickle (.pkl) or csv file, for compatibility.
+    '''
+    table = store_read(store_dir)
+    if path.endswith('.pkl'):
+        table.to_pickle(path)
+    else:
+        table.to_csv(path)
+
+
+#########################################################################
+# Cohort trace store
+#
+# A trace store is a directory with one raw float32 sessions x frames array per
+# metric (dvars, fd) and a meta.json with the sessions (the row index), the
+# width of each array and the frames of each trace. Shorter traces are padded
+# with NaN. Sessions are appended as they come, data first and meta.json last,
+# as in the columnar results store. meta.json also keeps the size and mtime of
+# the tables each row was read from: a session whose tables changed is appended
+# again, and its new row supersedes the old one (the last row of a session is
+# its current one).
+
+# metric: column read by read_trace, see trace_files.
+TRACE_METRICS = {'dvars': 0, 'fd': 'framewise_displacement'}
+
+def trace_files(subid, sesid):
+    '''
+        Canonical DVARS and motion tables of a session, by trace store metric.
+    '''
+    files = session_files(subid, sesid)
+    return {'dvars': files['dvars'], 'fd': files['motion']}
+
+def trace_file(trace_dir, metric, width):
+    return trace_dir + '/' + metric + '-' + str(width) + '.f32'
+
+def trace_stamps(session):
+    '''
+        [size, mtime] of the tables of a [participant_id, session_id] by metric, None where the
+        table does not exist.
+    '''
+    stamps = dict()
+    for metric, fname in trace_files(str(session[0]), str(session[1])).items():
+        try:
+            stat = os.stat(fname)
+            stamps[metric] = [stat.st_size, stat.st_mtime]
+        except OSError:
+            stamps[metric] = None
+    return stamps
+
+def trace_current(meta):
+    '''
+        (participant_id, session_id): current (last) row of each session of a trace store meta.json.
+    '''
+    return {tuple(session): row for row, session in enumerate(meta['sessions'])}
+
+def trace_changed(trace_dir, meta, stamps):
+    '''
+        (participant_id, session_id) keys of the sessions of a trace store whose tables changed since
+        their current row was read. stamps: dictionary of (participant_id, session_id) to trace_stamps.
+        Rows stored without stamps count as changed if a table is newer than meta.json.
+    '''
+    current = trace_current(meta)
+    row_stamps = meta.get('stamps', [None] * len(meta['sessions']))
+    stored = None
+    changed = set()
+    for key, session_stamps in stamps.items():
+        if key not in current:
+            continue
+        old = row_stamps[current[key]]
+        if old is None:
+            if stored is None:
+                stored = os.path.getmtime(trace_dir + '/meta.json')
+            if any(stamp is not None and stamp[1] > stored for stamp in session_stamps.values()):
+                changed.add(key)
+        elif any(old.get(metric) != stamp for metric, stamp in session_stamps.items()):
+            changed.add(key)
+    return changed
+
+def trace_append(trace_dir, sessions, traces, stamps=None):
+    '''
+        Appends the traces of new sessions to a trace store, creating it if needed.
+        Sessions already in the store are skipped, unless stamps are given and differ from the
+        ones of their current row: they are appended again and the new row supersedes the old.
+        An array is widened (rewritten) if a trace is longer than its width.
+        input:
+            sessions: list of [participant_id, session_id]
+            traces: dictionary of metric to a list with one 1-D trace per session, None if missing.
+            stamps: list with the trace_stamps of each session, the tables the traces were read from.
+        output:
+            amount of sessions appended.
+    '''
+    os.makedirs(trace_dir, exist_ok=True)
+    meta = store_meta(trace_dir)
+    if meta is None:
+        meta = {'sessions': [], 'widths': {}, 'lengths': {}, 'stamps': []}
+    rows = len(meta['sessions'])
+    meta.setdefault('stamps', [None] * rows)
+    current = trace_current(meta)
+    keys = [(str(subid), str(sesid)) for subid, sesid in sessions]
+    changed = trace_changed(trace_dir, meta, dict(zip(keys, stamps))) if stamps is not None and rows else set()
+    new = list()
+    for i, key in enumerate(keys):
+        if key not in current or key in changed:
+            new.append(i)
+            current[key] = None
+            changed.discard(key)
+    if not new:
+        return 0
+
+    stale = list()
+    for metric in set(meta['widths']) | set(traces):
+        metric_traces = traces.get(metric, [None] * len(sessions))
+        selected = [metric_traces[i] for i in new]
+        lengths = [0 if trace is None else len(trace) for trace in selected]
+        width = meta['widths'].get(metric, 0)
+        new_width = max([width] + lengths)
+        fname = trace_file(trace_dir, metric, new_width)
+        if new_width != width:
+            if metric in meta['widths']:
+                stale.append(trace_file(trace_dir, metric, width))
+            widened = np.full((rows, new_width), np.nan, dtype=np.float32)
+            if width > 0 and rows > 0:
+                widened[:, :width] = np.fromfile(trace_file(trace_dir, metric, width), dtype=np.float32,
+                                                 count=rows * width).reshape(rows, width)
+            widened.tofile(fname)
+        block = np.full((len(new), new_width), np.nan, dtype=np.float32)
+        for row, trace in enumerate(selected):
+            if trace is not None:
+                block[row, :len(trace)] = trace
+        with open(fname, 'ab') as fh:
+            # drop leftovers of an interrupted append
+            fh.truncate(rows * new_width * 4)
+            fh.write(block.tobytes())
+        meta['widths'][metric] = new_width
+        meta['lengths'][metric] = meta['lengths'].get(metric, [0] * rows) + lengths
+
+    meta['sessions'] = meta['sessions'] + [[str(sessions[i][0]), str(sessions[i][1])] for i in new]
+    meta['stamps'] = meta['stamps'] + [None if stamps is None else stamps[i] for i in new]
+    store_write_meta(trace_dir, meta)
+    for fname in stale:
+        os.remove(fname)
+    return len(new)
+
+def read_session_traces(session):
+    '''
+        Traces of a [participant_id, session_id] by metric, None where the table does not exist.
+        DVARS is read as dvars() reads it.
+    '''
+    files = trace_files(str(session[0]), str(session[1]))
+    return {metric: read_trace(files[metric], column) if file_exists(files[metric]) else None
+            for metric, column in TRACE_METRICS.items()}
+
+def build_traces(trace_dir, participants, threads=8):
+    '''
+        Adds the DVARS and framewise displacement traces of the sessions of a participants table
+        to a trace store. Only sessions not yet in the store, or whose tables changed (size or
+        mtime, see trace_stamps) since they were read, are read, so later runs only pay for new
+        and regenerated sessions.
+        output:
+            amount of sessions appended.
+    '''
+    from concurrent.futures import ThreadPoolExecutor
+
+    meta = store_meta(trace_dir)
+    sessions = [[str(subid), str(sesid)] for subid, sesid in zip(participants['participant_id'], participants['session_id'])]
+    with ThreadPoolExecutor(threads) as pool:
+        stamps = dict(zip(map(tuple, sessions), pool.map(trace_stamps, sessions)))
+        if meta is not None:
+            current = trace_current(meta)
+            changed = trace_changed(trace_dir, meta, stamps)
+            sessions = [session for session in sessions if tuple(session) not in current or tuple(session) in changed]
+        read = list(pool.map(read_session_traces, sessions))
+    traces = {metric: [session_traces[metric] for session_traces in read] for metric in TRACE_METRICS}
+    return trace_append(trace_dir, sessions, traces, [stamps[tuple(session)] for session in sessions])
+
+def trace_arrays(trace_dir, metrics=None):
+    '''
+        Memory-mapped sessions x frames float32 arrays of a trace store, rows in the order
+        of trace_sessions.
+        output:
+            dictionary of metric to numpy memmap.
+    '''
+    meta = store_meta(trace_dir)
+    if meta is None:
+        raise FileNotFoundError("No trace store at " + trace_dir)
+    if metrics is None:
+        metrics = list(meta['widths'])
+    rows = len(meta['sessions'])
+    arrays = dict()
+    for metric in metrics:
+        if metric not in meta['widths']:
+            raise ValueError("Unknown metric " + metric + ". Metrics: " + ", ".join(meta['widths']))
+        width = meta['widths'][metric]
+        if rows == 0 or width == 0:
+            arrays[metric] = np.full((rows, width), np.nan, dtype=np.float32)
+        else:
+            arrays[metric] = np.memmap(trace_file(trace_dir, metric, width), dtype=np.float32, mode='r', shape=(rows, width))
+    return arrays
+
+def trace_sessions(trace_dir):
+    '''
+        Session index of a trace store: participant_id, session_id, the frames of each
+        metric (<metric>_frames, 0 if its table was missing) and current (False for rows
+        superseded by a later read of the session), one row per array row.
+    '''
+    meta = store_meta(trace_dir)
+    if meta is None:
+        raise FileNotFoundError("No trace store at " + trace_dir)
+    sessions = np.array(meta['sessions'], dtype=object).reshape(-1, 2)
+    index = pd.DataFrame({'participant_id': sessions[:, 0], 'session_id': sessions[:, 1]})
+    for metric, lengths in meta['lengths'].items():
+        index[metric + '_frames'] = np.array(lengths, dtype=int)
+    current = np.zeros(len(index), dtype=bool)
+    current[list(trace_current(meta).values())] = True
+    index['current'] = current
+    return index
+
+def trace_rows(trace_dir, sessions):
+    '''
+        Array rows (current ones) of [participant_id, session_id] sessions, -1 for sessions not in the store.
+    '''
+    index = trace_sessions(trace_dir)
+    position = {key: i for i, key in enumerate(zip(index['participant_id'], index['session_id']))}
+    return np.array([position.get((str(subid), str(sesid)), -1) for subid, sesid in sessions], dtype=int)
+
+def trace_scores(trace_dir, sessions=None, keep_vols=1600, BOLD_length=2299, iqr_factor=1.5,
+                 fd_thresholds=(), chunk_rows=512, threshold=None, joint=None):
+    '''
+        Scores sessions straight from a trace store, chunk_rows sessions at a time: the DVARS
+        interval of dvars() (dvars_scores), the mean framewise displacement and, for each of
+        fd_thresholds, the longest low-motion streak of get_longeststreak (streak_table).
+        input:
+            sessions: list of [participant_id, session_id], all the (current) sessions of the store by default.
+            threshold: DVARS threshold for all sessions, or one per session, instead of each
+                subject's (see dvars_scores).
+            joint: None, or a dictionary with the fd_threshold and weights of joint_scores to choose
+                the windows of sessions with both traces on DVARS and FD together.
+        output:
+            pandas dataframe with participant_id, session_id, dvars_frames, fd_frames, dvars_outliers,
+            start_best_interval, mean_dvars, mean_fd and fd_streak_<threshold> columns, and with joint,
+            the fd_outliers and fd_sum of the window. Sessions without a DVARS (or motion) trace have
+            -1 and NaN in the DVARS (or FD) columns.
+    '''
+    index = trace_sessions(trace_dir)
+    if sessions is None:
+        rows = np.flatnonzero(index['current'].to_numpy())
+    else:
+        rows = trace_rows(trace_dir, sessions)
+        if (rows < 0).any():
+            raise ValueError("Sessions not in the trace store: " + str([sessions[i] for i in np.flatnonzero(rows < 0)]))
+    arrays = trace_arrays(trace_dir, ['dvars', 'fd'])
+    dvars_frames = index['dvars_frames'].to_numpy()[rows]
+    fd_frames = index['fd_frames'].to_numpy()[rows]
+
+    table = pd.DataFrame({'participant_id': index['participant_id'].to_numpy()[rows],
+                          'session_id': index['session_id'].to_numpy()[rows],
+                          'dvars_frames': dvars_frames, 'fd_frames': fd_frames})
+    dvars_outliers = np.full(len(rows), -1)
+    start_best_interval = np.full(len(rows), -1)
+    mean_dvars = np.full(len(rows), np.nan)
+    mean_fd = np.full(len(rows), np.nan)
+    streaks = np.full((len(rows), len(fd_thresholds)), -1)
+    fd_outliers = np.full(len(rows), -1)
+    fd_sum = np.full(len(rows), np.nan)
+    if threshold is not None:
+        threshold = np.broadcast_to(np.asarray(threshold, dtype=float), (len(rows),))
+
+    with timed('trace_scores'):
+        for chunk in range(0, len(rows), chunk_rows):
+            positions = np.arange(chunk, min(chunk + chunk_rows, len(rows)))
+            if joint is None:
+                both = np.zeros(len(positions), dtype=bool)
+            else:
+                both = (dvars_frames[positions] > 0) & (fd_frames[positions] > 0)
+            scored = positions[both]
+            if len(scored):
+                traces = np.asarray(arrays['dvars'][rows[scored], :dvars_frames[scored].max()], dtype=float)
+                fd = np.asarray(arrays['fd'][rows[scored], :fd_frames[scored].max()], dtype=float)
+                dvars_outliers[scored], fd_outliers[scored], fd_sum[scored], start_best_interval[scored], mean_dvars[scored] = \
+                    joint_scores(traces, fd, keep_vols, BOLD_length, iqr_factor, joint.get('fd_threshold', 0.5),
+                                 joint.get('weights'), None if threshold is None else threshold[scored])
+            scored = positions[(dvars_frames[positions] > 0) & ~both]
+            if len(scored):
+                traces = np.asarray(arrays['dvars'][rows[scored], :dvars_frames[scored].max()], dtype=float)
+                dvars_outliers[scored], start_best_interval[scored], mean_dvars[scored] = \
+                    dvars_scores(traces, keep_vols, BOLD_length, iqr_factor,
+                                 None if threshold is None else threshold[scored])
+            scored = positions[fd_frames[positions] > 0]
+            if len(scored):
+                fd = np.asarray(arrays['fd'][rows[scored], :fd_frames[scored].max()], dtype=float)
+                mean_fd[scored] = np.nanmean(fd, axis=1)
+                if len(fd_thresholds):
+                    streaks[scored] = streak_table(fd, fd_thresholds)[0].to_numpy()
+
+    table['dvars_outliers'] = dvars_outliers
+    table['start_best_interval'] = start_best_interval
+    table['mean_dvars'] = mean_dvars
+    table['mean_fd'] = mean_fd
+    if joint is not None:
+        table['fd_outliers'] = fd_outliers
+        table['fd_sum'] = fd_sum
+    for i, threshold in enumerate(fd_thresholds):
+        table['fd_streak_' + str(threshold)] = streaks[:, i]
+    return table
@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+
+"""
+    dhcpy_bench.py: Synthetic dHCP-like dataset generator and stage 1 benchmarks.
+
+    Description: Writes a synthetic tree with the canonical dHCP 2nd release layout (dhcp_fmri_pipeline/sub-*/ses-*/func
+    with the 4-D BOLD image, *DVARS.csv and _motion.tsv, sub-*_sessions.tsv, and a participants table) so that dhcpy and
+    1-frame_censoring.py can be measured without access to the release. Benchmarks report throughput, latency percentiles
+    and peak memory per function, and the end-to-end script run.
+
+    Usage:
+
+        python dhcpy_bench.py generate --root /tmp/dhcp_synth --sessions 100 --size small
+        python dhcpy_bench.py run --root /tmp/dhcp_synth --out bench.csv [--repeat 3] [--threads 4]
+        python dhcpy_bench.py check --root /tmp/dhcp_synth
+
+    The generated tree is used through the DHCP_ROOT environment variable (see dhcpy.dhcp_root).
+"""
+
+import os
+import sys
+import time
+import tracemalloc
+import resource
+import subprocess
+import tempfile
+import argparse
+from shutil import rmtree
+import numpy as np
+import pandas as pd
+
+import dhcpy
+
+# (x, y, z) of the BOLD images. realistic is the dHCP 2nd release fMRI grid.
+SIZES = {'tiny': (4, 4, 3), 'small': (16, 16, 12), 'realistic': (67, 67, 45)}
+
+# written by make_dataset at the root of a synthetic tree, bench_script only deletes crops under such a root.
+SYNTHETIC_MARKER = '.dhcpy_bench_synthetic'
+
+def make_dataset(root, n_sessions=10, size='small', n_frames=2299, bold=True, seed=0):
+    '''
+        Writes a synthetic dhcp tree under root with n_sessions single-session subjects.
+        DVARS traces are gamma distributed with a few motion bursts, framewise displacement
+        follows them, BOLD images are float32 noise around 500 (skipped if not bold).
+        Also writes root/participants.pkl and .tsv, the input table of 1-frame_censoring.py, and
+        the SYNTHETIC_MARKER file.
+        returns the participants dataframe.
+    '''
+    import nibabel as nib
+
+    rng = np.random.default_rng(seed)
+    funcdir = root + '/dhcp_fmri_pipeline'
+    rows = list()
+    for k in range(n_sessions):
+        subid = 'CC' + str(k).zfill(5) + 'XX' + str(k % 100).zfill(2)
+        sesid = str(1000 + k)
+        session_path = funcdir + '/sub-' + subid + '/ses-' + sesid + '/func'
+        os.makedirs(session_path, exist_ok=True)
+        fname = session_path + '/sub-' + subid + '_ses-' + sesid
+
+        subject_dvars = rng.gamma(4, 8, n_frames)
+        for burst in rng.integers(0, n_frames - 20, rng.integers(1, 6)):
+            subject_dvars[burst:burst + rng.integers(2, 20)] += rng.gamma(4, 20)
+        subject_dvars[0] = 0
+        np.savetxt(fname + 'DVARS.csv', subject_dvars, fmt='%.6f')
+        fd = subject_dvars / 200 * rng.gamma(2, 0.5, n_frames)
+        pd.DataFrame({'trans_x': rng.normal(0, 0.1, n_frames), 'trans_y': rng.normal(0, 0.1, n_frames),
+                      'trans_z': rng.normal(0, 0.1, n_frames), 'framewise_displacement': fd}
+                     ).to_csv(fname + '_motion.tsv', sep='\t', index=False)
+        if bold:
+            data = (rng.normal(size=SIZES[size] + (n_frames,)) * 10 + 500).astype(np.float32)
+            nib.save(nib.Nifti1Image(data, np.diag([2.15, 2.15, 2.15, 1])),
+                     fname + '_task-rest_desc-preproc_bold.nii.gz')
+
+        scan_age = round(float(rng.uniform(37, 44)), 2)
+        birth_age = round(float(rng.uniform(28, 42)), 2)
+        with open(funcdir + '/sub-' + subid + '/sub-' + subid + '_sessions.tsv', 'w') as fh:
+            fh.write('session_id\tscan_age\n' + sesid + '\t' + str(scan_age) + '\n')
+        rows.append({'participant_id': subid, 'session_id': int(sesid), 'sex': ['male', 'female'][k % 2],
+                     'birth_age': birth_age, 'birth_weight': round(float(rng.uniform(1, 4.5)), 2),
+                     'singleton': 'single' if k % 10 else 'multiple', 'scan_age': scan_age, 'scan_number': 1})
+
+    participants = pd.DataFrame(rows)
+    participants.to_pickle(root + '/participants.pkl')
+    participants.to_csv(root + '/participants.tsv', sep='\t', index=False)
+    open(root + '/' + SYNTHETIC_MARKER, 'w').close()
+    return participants
+
+def bench(name, function, inputs, repeat=1):
+    '''
+        Times function(*args) over every args of inputs, repeat times, and measures its peak
+        traced memory (tracemalloc, numpy included) in a separate pass over the first input.
+        returns a dictionary with calls, throughput, latency percentiles (ms) and peak MB.
+    '''
+    latencies = list()
+    for _ in range(repeat):
+        for args in inputs:
+            start = time.perf_counter()
+            function(*args)
+            latencies.append(time.perf_counter() - start)
+    tracemalloc.start()
+    function(*inputs[0])
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    latencies = np.asarray(latencies) * 1000
+    return {'function': name, 'calls': len(latencies), 'throughput_per_s': 1000 * len(latencies) / latencies.sum(),
+            'mean_ms': latencies.mean(), 'p50_ms': np.percentile(latencies, 50),
+            'p95_ms': np.percentile(latencies, 95), 'p99_ms': np.percentile(latencies, 99),
+            'peak_mb': peak / 2 ** 20}
+
+def bench_script(root, threads=4):
+    '''
+        Runs 1-frame_censoring.py end to end on the synthetic tree in a subprocess, after removing
+        previous crops so that every session is cropped. Refuses roots without the SYNTHETIC_MARKER
+        of make_dataset, so that the crops of a real release are never deleted.
+        returns a dictionary in the format of bench, with the children's peak RSS.
+    '''
+    if not os.path.exists(root + '/' + SYNTHETIC_MARKER):
+        raise ValueError(root + " is not a synthetic tree of make_dataset (no " + SYNTHETIC_MARKER +
+                         "), refusing to delete its dhcp_fmri_cropped directory")
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '1-frame_censoring.py')
+    env = dict(os.environ, DHCP_ROOT=root,
+               PYTHONPATH=os.path.dirname(os.path.abspath(__file__)) + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    rmtree(root + '/dhcp_fmri_cropped', ignore_errors=True)
+    with tempfile.TemporaryDirectory() as out_dir:
+        start = time.perf_counter()
+        subprocess.run([sys.executable, script, '--in', root + '/participants', '--out', out_dir + '/out',
+                        '--threads', str(threads), '--crop_threads', str(threads)],
+                       env=env, check=True, stdout=subprocess.DEVNULL)
+        elapsed = (time.perf_counter() - start) * 1000
+    n_sessions = len(pd.read_pickle(root + '/participants.pkl'))
+    return {'function': '1-frame_censoring.py', 'calls': 1, 'throughput_per_s': 1000 * n_sessions / elapsed,
+            'mean_ms': elapsed, 'p50_ms': elapsed, 'p95_ms': elapsed, 'p99_ms': elapsed,
+            'peak_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024}
+
+def bench_boldstats(root, threads=4):
+    '''
+        Runs dhcpy.boldstats (process pool of bold_image_stats) over every session of the synthetic
+        tree, answering get_niftiPath from a manifest of the tree.
+        returns a dictionary in the format of bench, throughput in sessions per second, with the
+        children's peak RSS.
+    '''
+    participants = pd.read_pickle(root + '/participants.pkl')
+    dhcpy.use_manifest(dhcpy.build_manifest(root, pipelines=("dhcp_fmri_pipeline",)))
+    try:
+        with tempfile.TemporaryDirectory() as subjects_directory:
+            for subid in participants['participant_id'].unique():
+                os.mkdir(subjects_directory + '/' + subid)
+            start = time.perf_counter()
+            dhcpy.boldstats(subjects_directory, threads=threads)
+            elapsed = (time.perf_counter() - start) * 1000
+    finally:
+        dhcpy.use_manifest(None)
+    n_subjects = participants['participant_id'].nunique()
+    return {'function': 'boldstats', 'calls': 1, 'throughput_per_s': 1000 * n_subjects / elapsed,
+            'mean_ms': elapsed, 'p50_ms': elapsed, 'p95_ms': elapsed, 'p99_ms': elapsed,
+            'peak_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024}
+
+def check_trace_scores(root, keep_vols=1600, BOLD_length=2299):
+    '''
+        Checks that the trace store scores (dhcpy.trace_scores) of every session of a synthetic tree
+        match dvars() on its DVARS table: same outliers and window start, mean within float32 precision.
+        Raises ValueError with the mismatching sessions.
+    '''
+    os.environ['DHCP_ROOT'] = root
+    participants = pd.read_pickle(root + '/participants.pkl')
+    with tempfile.TemporaryDirectory() as trace_dir:
+        dhcpy.build_traces(trace_dir, participants)
+        table = dhcpy.trace_scores(trace_dir, keep_vols=keep_vols, BOLD_length=BOLD_length)
+    mismatches = list()
+    for row in table.itertuples():
+        vols_dvars, index_dvars, mean_dvars = dhcpy.dvars(dhcpy.session_files(row.participant_id, row.session_id)['dvars'],
+                                                          keep_vols, BOLD_length)
+        if (row.dvars_outliers != vols_dvars or row.start_best_interval != index_dvars
+                or not np.isclose(row.mean_dvars, mean_dvars, rtol=1e-5)):
+            mismatches.append((row.participant_id, row.session_id))
+    if mismatches:
+        raise ValueError("trace_scores does not match dvars() for sessions " + str(mismatches))
+    return len(table)
+
+def run_benchmarks(root, repeat=1, threads=4, script=True):
+    '''
+        Checks trace_scores against dvars (check_trace_scores), then benchmarks csv2pd, read_trace, dvars,
+        get_longeststreak, crop_nifti, bold_image_stats, boldstats and, if script, the end-to-end censoring
+        script on a synthetic tree made by make_dataset.
+        Throughput is per session (per call), except for boldstats and the script (sessions per second).
+        returns a pandas dataframe, one row per function.
+    '''
+    os.environ['DHCP_ROOT'] = root
+    check_trace_scores(root)
+    participants = pd.read_pickle(root + '/participants.pkl')
+    funcdir = root + '/dhcp_fmri_pipeline'
+    fnames = [funcdir + '/sub-' + row.participant_id + '/ses-' + str(row.session_id) + '/func/sub-' +
+              row.participant_id + '_ses-' + str(row.session_id) for row in participants.itertuples()]
+    dvars_files = [(fname + 'DVARS.csv',) for fname in fnames]
+    motion_files = [(fname + '_motion.tsv',) for fname in fnames]
+    fd_tables = [(dhcpy.read_table(fname[0]), 0.2) for fname in motion_files]
+    bold_files = [fname + '_task-rest_desc-preproc_bold.nii.gz' for fname in fnames]
+    bold_files = [bold for bold in bold_files if os.path.exists(bold)]
+
+    results = [bench('csv2pd', dhcpy.csv2pd, motion_files, repeat),
+               bench('read_trace', lambda path: dhcpy.read_trace(path, 'framewise_displacement'), motion_files, repeat),
+               bench('dvars', dhcpy.dvars, dvars_files, repeat),
+               bench('get_longeststreak', dhcpy.get_longeststreak, fd_tables, repeat)]
+    if bold_files:
+        with tempfile.TemporaryDirectory() as out_dir:
+            results.append(bench('crop_nifti', lambda bold: dhcpy.crop_nifti(bold, out_dir + '/cropped.nii.gz', 0),
+                                 [(bold,) for bold in bold_files], repeat))
+            results.append(bench('crop_nifti_bgz', lambda bold: dhcpy.crop_nifti(bold, out_dir + '/cropped.nii.gz', 0, threads=threads),
+                                 [(bold,) for bold in bold_files], repeat))
+            results.append(bench('crop_nifti_nii', lambda bold: dhcpy.crop_nifti(bold, out_dir + '/cropped.nii', 0),
+                                 [(bold,) for bold in bold_files], repeat))
+        results.append(bench('bold_image_stats', dhcpy.bold_image_stats, [(bold,) for bold in bold_files], repeat))
+        results.append(bench_boldstats(root, threads))
+    if script:
+        results.append(bench_script(root, threads))
+    return pd.DataFrame(results)
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    generate = subparsers.add_parser('generate', help='write a synthetic dhcp tree')
+    generate.add_argument('--root', type=str, required=True, help='root directory of the synthetic tree')
+    generate.add_argument('--sessions', type=int, default=10, help='amount of sessions, e.g. 10, 100 or 1000')
+    generate.add_argument('--size', type=str, default='small', choices=sorted(SIZES), help='size of the BOLD images')
+    generate.add_argument('--frames', type=int, default=2299, help='frames per run')
+    generate.add_argument('--no_bold', action='store_true', help='only write the tables')
+    generate.add_argument('--seed', type=int, default=0, help='random seed')
+    run = subparsers.add_parser('run', help='benchmark stage 1 on a synthetic tree')
+    run.add_argument('--root', type=str, required=True, help='root directory of the synthetic tree')
+    run.add_argument('--out', type=str, default=None, help='csv file for the results')
+    run.add_argument('--repeat', type=int, default=1, help='passes over the sessions per function')
+    run.add_argument('--threads', type=int, default=4, help='threads of the end-to-end script')
+    run.add_argument('--no_script', action='store_true', help='skip the end-to-end script')
+    check = subparsers.add_parser('check', help='check the trace store scores against dvars() on a synthetic tree')
+    check.add_argument('--root', type=str, required=True, help='root directory of the synthetic tree')
+    args = parser.parse_args()
+
+    if args.command == 'generate':
+        make_dataset(args.root, args.sessions, args.size, args.frames, not args.no_bold, args.seed)
+    elif args.command == 'check':
+        print(str(check_trace_scores(args.root)) + " sessions: trace_scores matches dvars()")
+    else:
+        results = run_benchmarks(args.root, args.repeat, args.threads, not args.no_script)
+        print(results.to_string(index=False))
+        if args.out:
+            results.to_csv(args.out, index=False)
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+
+"""
+    dhcpy_cli.py: Command line interface of the dhcpy library.
+
+    Description: Small queries and single-session steps for shell scripts and job arrays, without writing a python
+    script for each. dhcpy imports pandas and numpy on first use (see dhcpy.LazyModule), so the path and session
+    subcommands start in a fraction of the time of `python -c "from dhcpy import ..."` with eager imports.
+
+    Usage:
+
+        python dhcpy_cli.py [--root DIR] [--manifest manifest.json] <subcommand> ...
+
+        paths SUBID [SESID]             canonical bold, motion, dvars and cropped paths of the sessions of a subject.
+        sessions SUBID                  session ids and scan ages of a subject.
+        filter TABLE EXPRESSION         rows of a table (pickle, csv/tsv or results store) matching a query
+                                        expression (see dhcpy.query), e.g. "term and scan_age >= 37".
+        censor SUBID SESID              DVARS censoring scores of a session, as 1-frame_censoring.py (json).
+        crop SUBID SESID START          crops the BOLD image of a session from frame START, prints the output path.
+        stats BOLD                      mean, sd, min and max of a 4-D image (dhcpy.bold_image_stats).
+
+    --root overrides DHCP_ROOT, --manifest answers paths, sessions and ages from a saved manifest (dhcpy.build_manifest).
+"""
+
+import os
+import sys
+import json
+import argparse
+
+import dhcpy
+
+def cmd_paths(args):
+    sessions = [args.sesid] if args.sesid else dhcpy.get_sessions(args.subid)
+    for sesid in sessions:
+        for name, path in dhcpy.session_files(args.subid, sesid).items():
+            print(sesid + '\t' + name + '\t' + path)
+
+def cmd_sessions(args):
+    for sesid in dhcpy.get_sessions(args.subid):
+        print(sesid + '\t' + str(dhcpy.get_scanage(args.subid, sesid)))
+
+def cmd_filter(args):
+    table = dhcpy.load_table(args.table)
+    qc = dhcpy.load_table(args.qc) if args.qc else None
+    selected = dhcpy.query(table, args.expression, qc)
+    if args.columns:
+        selected = selected[args.columns.split(',')]
+    if args.out:
+        if args.out.endswith('.pkl'):
+            selected.to_pickle(args.out)
+        else:
+            selected.to_csv(args.out, sep='\t' if args.out.endswith('.tsv') else ',', index=False)
+    else:
+        selected.to_csv(sys.stdout, sep='\t', index=False)
+
+def cmd_censor(args):
+    files = dhcpy.session_files(args.subid, args.sesid)
+    if not dhcpy.file_exists(files['dvars']):
+        raise SystemExit("dvars does not exist: " + files['dvars'])
+    subject_dvars = dhcpy.read_trace(files['dvars'])
+    subject_fd = dhcpy.read_trace(files['motion'], 'framewise_displacement')
+    if args.joint:
+        vols_dvars, fd_outliers, fd_sum, index_dvars, mean_dvars = dhcpy.joint_scores(
+            subject_dvars, subject_fd, args.keep_vols, args.bold_length, args.iqr_factor, args.fd_threshold,
+            threshold=args.threshold)
+    else:
+        vols_dvars, index_dvars, mean_dvars = dhcpy.dvars_scores(subject_dvars, args.keep_vols, args.bold_length,
+                                                                 args.iqr_factor, args.threshold)
+    print(json.dumps({'participant_id': args.subid, 'session_id': args.sesid,
+                      'dvars_outliers': int(vols_dvars), 'mean_dvars': float(mean_dvars),
+                      'start_best_interval': int(index_dvars), 'mean_fd': float(subject_fd.mean())}))
+
+def cmd_crop(args):
+    print(dhcpy.crop(args.subid, args.sesid, args.start, args.length, args.method, args.format, args.gzip_threads))
+
+def cmd_stats(args):
+    mean, sd, minimum, maximum = dhcpy.bold_image_stats(args.bold, maps_prefix=args.maps)
+    print(json.dumps({'mean': mean, 'sd': sd, 'min': minimum, 'max': maximum}))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="dhcpy command line interface")
+    parser.add_argument('--root', type=str, default=None, help='dHCP root directory, overrides DHCP_ROOT')
+    parser.add_argument('--manifest', type=str, default=None, help='saved dataset manifest (see dhcpy.build_manifest)')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    paths = subparsers.add_parser('paths', help='canonical paths of the sessions of a subject')
+    paths.add_argument('subid', type=str)
+    paths.add_argument('sesid', type=str, nargs='?', default=None)
+    paths.set_defaults(run=cmd_paths)
+
+    sessions = subparsers.add_parser('sessions', help='session ids and scan ages of a subject')
+    sessions.add_argument('subid', type=str)
+    sessions.set_defaults(run=cmd_sessions)
+
+    query = subparsers.add_parser('filter', help='rows of a table matching a query expression')
+    query.add_argument('table', type=str, help='pickle, csv/tsv or results store directory')
+    query.add_argument('expression', type=str, help='query expression, see dhcpy.query')
+    query.add_argument('--qc', type=str, default=None, help='QC table joined on participant_id and session_id')
+    query.add_argument('--columns', type=str, default=None, help='comma-separated columns to output')
+    query.add_argument('--out', type=str, default=None, help='output file (.pkl, .csv or .tsv), stdout (tsv) by default')
+    query.set_defaults(run=cmd_filter)
+
+    censor = subparsers.add_parser('censor', help='DVARS censoring scores of a session')
+    censor.add_argument('subid', type=str)
+    censor.add_argument('sesid', type=str)
+    censor.add_argument('--keep_vols', type=int, default=1600, help='length of the retained window of frames')
+    censor.add_argument('--bold_length', type=int, default=2299, help='length of the BOLD run in frames')
+    censor.add_argument('--iqr_factor', type=float, default=1.5, help='IQR multiplier of the DVARS threshold')
+    censor.add_argument('--threshold', type=float, default=None, help='fixed (e.g. cohort) DVARS threshold')
+    censor.add_argument('--joint', action='store_true', help='choose the window on DVARS and FD (dhcpy.joint_scores)')
+    censor.add_argument('--fd_threshold', type=float, default=0.5, help='framewise displacement of an FD outlier')
+    censor.set_defaults(run=cmd_censor)
+
+    crop = subparsers.add_parser('crop', help='crop the BOLD image of a session')
+    crop.add_argument('subid', type=str)
+    crop.add_argument('sesid', type=str)
+    crop.add_argument('start', type=int, help='first frame of the retained window')
+    crop.add_argument('--length', type=int, default=1600, help='frames to keep')
+    crop.add_argument('--method', type=str, default="native", choices=["native", "fsl"])
+    crop.add_argument('--format', type=str, default="gz", choices=["gz", "bgz", "nii"])
+    crop.add_argument('--gzip_threads', type=int, default=4)
+    crop.set_defaults(run=cmd_crop)
+
+    stats = subparsers.add_parser('stats', help='mean, sd, min and max of a 4-D image')
+    stats.add_argument('bold', type=str)
+    stats.add_argument('--maps', type=str, default=None, help='also write voxelwise mean, sd and tSNR maps with this prefix')
+    stats.set_defaults(run=cmd_stats)
+
+    args = parser.parse_args(argv)
+    if args.root:
+        os.environ['DHCP_ROOT'] = args.root
+    if args.manifest:
+        dhcpy.use_manifest(args.manifest)
+    args.run(args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+
+"""
+    dhcpy_scheduler.py: Memory-aware local scheduler for the pipeline stages 1, 5 and 6.
+
+    Description: Packs the R/FSL/python subprocess jobs of the pipeline (frame censoring -> population priors template ->
+    individual inference) onto one node, so that the jobs running at the same time fit in its cores and memory.
+    Cores and available memory are detected (or read from a node config) instead of hard-coded per hostname as in
+    dhcpy.init_host. Each job declares, or takes from its stage, an estimate of its threads and memory. Jobs start
+    when their dependencies finished, largest memory first. Jobs killed for memory are retried with a larger estimate
+    after a back-off, other failures are retried as they are.
+
+    Usage:
+
+        python dhcpy_scheduler.py jobs.json [--node node.json] [--cores N] [--memory_gb M] [--logs ./logs]
+
+    jobs.json is a list of jobs:
+
+        [{"name": "censoring", "stage": "censoring", "command": ["python", "1-frame_censoring.py", ...]},
+         {"name": "priors", "stage": "priors", "after": ["censoring"], "command": ["Rscript", "5-population_priors.r", ...]},
+         {"name": "CC00050XX01", "stage": "inference", "after": ["priors"], "command": ["Rscript", "6-individual_inference.r", ...]}]
+
+    with optional "threads", "memory_gb" and "retries" overriding the stage estimates (STAGE_ESTIMATES).
+    node.json may set "cores" and "memory_gb".
+"""
+
+import os
+import json
+import time
+import subprocess
+import argparse
+
+# Per-stage estimates. inference: ~100 GB per job (see 6-individual_inference.r) with OMP_NUM_THREADS=2.
+STAGE_ESTIMATES = {'censoring': {'threads': 8, 'memory_gb': 8},
+                   'priors': {'threads': 8, 'memory_gb': 32},
+                   'inference': {'threads': 2, 'memory_gb': 100},
+                   'default': {'threads': 1, 'memory_gb': 4}}
+
+# stderr messages of jobs that ran out of memory (python, R, C++).
+OOM_MESSAGES = ['MemoryError', 'Cannot allocate memory', 'cannot allocate vector', 'std::bad_alloc', 'Out of memory']
+
+def node_resources(node_file=None, cores=None, memory_gb=None):
+    '''
+        Cores and available memory (GB) of this node: detected from the cpu affinity and
+        /proc/meminfo (MemAvailable), overridden by node_file ({"cores", "memory_gb"}) and then
+        by the cores and memory_gb arguments.
+        returns [cores, memory_gb]
+    '''
+    detected_cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    detected_memory = None
+    if os.path.exists('/proc/meminfo'):
+        with open('/proc/meminfo') as fh:
+            for line in fh:
+                if line.startswith('MemAvailable:'):
+                    detected_memory = int(line.split()[1]) / 2 ** 20
+    if detected_memory is None:
+        detected_memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 2 ** 30
+
+    if node_file:
+        with open(node_file) as fh:
+            node = json.load(fh)
+        detected_cores = node.get('cores', detected_cores)
+        detected_memory = node.get('memory_gb', detected_memory)
+    return [cores or detected_cores, memory_gb or detected_memory]
+
+def load_jobs(jobs_file):
+    '''
+        Reads a jobs file and fills threads, memory_gb, retries and after from the stage estimates.
+    '''
+    with open(jobs_file) as fh:
+        jobs = json.load(fh)
+    for job in jobs:
+        estimate = STAGE_ESTIMATES.get(job.get('stage', 'default'), STAGE_ESTIMATES['default'])
+        job.setdefault('threads', estimate['threads'])
+        job.setdefault('memory_gb', estimate['memory_gb'])
+        job.setdefault('retries', 2)
+        job.setdefault('after', list())
+    return jobs
+
+def check_graph(jobs):
+    '''
+        Raises ValueError for duplicated names, unknown dependencies or dependency cycles.
+    '''
+    names = [job['name'] for job in jobs]
+    if len(set(names)) != len(names):
+        raise ValueError("Duplicated job names.")
+    after = {job['name']: job['after'] for job in jobs}
+    for name, dependencies in after.items():
+        for dependency in dependencies:
+            if dependency not in after:
+                raise ValueError("Job " + name + " depends on unknown job " + dependency)
+    # Kahn's algorithm, every job must be reachable in topological order
+    remaining = {name: len(dependencies) for name, dependencies in after.items()}
+    ready = [name for name, n in remaining.items() if n == 0]
+    seen = 0
+    while ready:
+        name = ready.pop()
+        seen = seen + 1
+        for other, dependencies in after.items():
+            if name in dependencies:
+                remaining[other] = remaining[other] - 1
+                if remaining[other] == 0:
+                    ready.append(other)
+    if seen != len(jobs):
+        raise ValueError("The job dependencies have a cycle.")
+
+def is_oom(returncode, log_file, start=0):
+    '''
+        True if a job was killed by the OOM killer (SIGKILL) or reported running out of memory.
+        Only the log written from byte start on (this attempt, logs are appended across retries)
+        is searched, at most its last 64 KB.
+    '''
+    if returncode in (-9, 137):
+        return True
+    try:
+        with open(log_file, errors='replace') as fh:
+            fh.seek(max(os.path.getsize(log_file) - 65536, start))
+            tail = fh.read()
+    except OSError:
+        return False
+    return any(message in tail for message in OOM_MESSAGES)
+
+def run_jobs(jobs, cores, memory_gb, logs='./logs', backoff=30, oom_growth=1.5, poll=1.0):
+    '''
+        Runs jobs (see load_jobs) on this node within cores and memory_gb.
+        Ready jobs (dependencies done) start largest memory first while they fit; a job larger than
+        the node runs alone. OMP_NUM_THREADS is set to each job's threads. Failed jobs are retried
+        up to their retries after backoff * 2^attempt seconds, jobs killed for memory with their
+        estimate grown by oom_growth. Jobs that cannot start (e.g. command not found) fail without
+        retries. Dependents of jobs that failed for good are skipped. Running jobs are terminated if
+        the scheduler is interrupted.
+        returns a dictionary of job name to 'done', 'failed' or 'skipped'.
+    '''
+    check_graph(jobs)
+    os.makedirs(logs, exist_ok=True)
+    by_name = {job['name']: dict(job) for job in jobs}
+    state = {name: 'pending' for name in by_name}
+    attempts = {name: 0 for name in by_name}
+    not_before = {name: 0.0 for name in by_name}
+    running = dict()
+    free_cores, free_memory = cores, memory_gb
+
+    try:
+        while any(status in ('pending', 'running') for status in state.values()):
+            # finished jobs
+            for name, [process, log_handle, log_start] in list(running.items()):
+                returncode = process.poll()
+                if returncode is None:
+                    continue
+                log_handle.close()
+                del running[name]
+                job = by_name[name]
+                free_cores = free_cores + min(job['threads'], cores)
+                free_memory = free_memory + min(job['memory_gb'], memory_gb)
+                if returncode == 0:
+                    state[name] = 'done'
+                    print("done: " + name)
+                    continue
+                oom = is_oom(returncode, logs + '/' + name + '.log', log_start)
+                if attempts[name] <= job['retries']:
+                    if oom:
+                        job['memory_gb'] = job['memory_gb'] * oom_growth
+                    not_before[name] = time.time() + backoff * 2 ** (attempts[name] - 1)
+                    state[name] = 'pending'
+                    print(("out of memory" if oom else "failed") + ": " + name + ", retrying (" + str(attempts[name]) + ")")
+                else:
+                    state[name] = 'failed'
+                    print("failed: " + name + " (exit " + str(returncode) + "), see " + logs + '/' + name + '.log')
+
+            # skip dependents of failed jobs
+            for name, job in by_name.items():
+                if state[name] == 'pending' and any(state[dependency] in ('failed', 'skipped')
+                                                    for dependency in job['after']):
+                    state[name] = 'skipped'
+                    print("skipped: " + name)
+
+            # start ready jobs that fit, largest memory first
+            ready = [by_name[name] for name, status in state.items()
+                     if status == 'pending' and time.time() >= not_before[name]
+                     and all(state[dependency] == 'done' for dependency in by_name[name]['after'])]
+            for job in sorted(ready, key=lambda job: job['memory_gb'], reverse=True):
+                threads = min(job['threads'], cores)
+                memory = min(job['memory_gb'], memory_gb)
+                if threads > free_cores or memory > free_memory:
+                    continue
+                log_handle = open(logs + '/' + job['name'] + '.log', 'a')
+                log_start = log_handle.tell()
+                env = dict(os.environ, OMP_NUM_THREADS=str(threads), **job.get('env', {}))
+                try:
+                    process = subprocess.Popen(job['command'], stdout=log_handle, stderr=subprocess.STDOUT,
+                                               env=env, cwd=job.get('cwd'))
+                except OSError as e:
+                    # e.g. command not found or bad cwd, not retried
+                    log_handle.write("could not start: " + repr(e) + "\n")
+                    log_handle.close()
+                    state[job['name']] = 'failed'
+                    print("failed: " + job['name'] + " could not start (" + repr(e) + ")")
+                    continue
+                running[job['name']] = [process, log_handle, log_start]
+                state[job['name']] = 'running'
+                attempts[job['name']] = attempts[job['name']] + 1
+                free_cores = free_cores - threads
+                free_memory = free_memory - memory
+                print("started: " + job['name'] + " (" + str(threads) + " threads, " + str(round(memory, 1)) + " GB)")
+
+            time.sleep(poll)
+    finally:
+        # interrupted (or failed): do not leave running jobs behind
+        for name, [process, log_handle, log_start] in running.items():
+            process.terminate()
+        for name, [process, log_handle, log_start] in running.items():
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+            log_handle.close()
+            print("terminated: " + name)
+
+    return state
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('jobs', type=str, help='jobs file (json)')
+    parser.add_argument('--node', type=str, default=None, help='node config (json) with cores and memory_gb')
+    parser.add_argument('--cores', type=int, default=None, help='cores to use, detected by default')
+    parser.add_argument('--memory_gb', type=float, default=None, help='memory to use, available memory by default')
+    parser.add_argument('--logs', type=str, default='./logs', help='directory of the job logs')
+    parser.add_argument('--backoff', type=float, default=30, help='seconds before the first retry of a failed job')
+    args = parser.parse_args()
+
+    cores, memory_gb = node_resources(args.node, args.cores, args.memory_gb)
+    print("node: " + str(cores) + " cores, " + str(round(memory_gb, 1)) + " GB")
+    final = run_jobs(load_jobs(args.jobs), cores, memory_gb, args.logs, args.backoff)
+    counts = {status: list(final.values()).count(status) for status in ('done', 'failed', 'skipped')}
+    print(counts)
+    raise SystemExit(0 if counts['failed'] == 0 and counts['skipped'] == 0 else 1)